@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+camera_object_memory.py
+Measures the memory held per tracked object for CameraObject and CompactCameraObject.
+Every object is built the way the tracker builds them: one detection per frame merged into the first one.
+
+    python benchmarks/camera_object_memory.py [objects] [updates per object]
+"""
+
+import sys
+import json
+import tracemalloc
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from camera_object import CameraObject, CompactCameraObject
+
+
+def build_objects(objectClass, objectCount, updates):
+    start = datetime.fromisoformat("2025-10-06T18:55:21.053Z")
+    centerOfGravity = {"x": "0.25", "y": "-0.5"}
+    objects = []
+    for objectId in range(objectCount):
+        trackedObject = objectClass(str(objectId), start, centerOfGravity=centerOfGravity, detectedType="Car", detectionCertainty=0.9, speed=10.0, objectCenter=(35.27, -120.66))
+        for update in range(1, updates):
+            detection = objectClass(str(objectId), start + timedelta(seconds=update / 10), centerOfGravity=centerOfGravity, detectedType="Car", detectionCertainty=0.9, speed=10.0, objectCenter=(35.27 + update * 1e-6, -120.66))
+            detection.add_lane("North")
+            trackedObject.add_data(detection)
+        objects.append(trackedObject)
+    return objects
+
+
+def measure(objectClass, objectCount, updates):
+    tracemalloc.start()
+    objects = build_objects(objectClass, objectCount, updates)
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    return current / objectCount
+
+
+if __name__ == "__main__":
+    objectCount = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    updates = int(sys.argv[2]) if len(sys.argv) > 2 else 100
+    before = measure(CameraObject, objectCount, updates)
+    after = measure(CompactCameraObject, objectCount, updates)
+    print(json.dumps({
+        "objects": objectCount,
+        "updates_per_object": updates,
+        "CameraObject_bytes_per_object": round(before),
+        "CompactCameraObject_bytes_per_object": round(after),
+        "ratio": round(after / before, 3)
+    }, indent=4))
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+"""
+ingest_benchmark.py
+Replays captured metadata through each stage of the ingest pipeline on its own, and then end to end:
+
+    framing      MetadataFramer over the raw bytes, in pipe-sized chunks
+    handler      MetadataHandler (streaming pull parser), tracker step left out
+    parseXml     xmlmetadata.parseXml, once per parser backend
+    zones        pointSearch.whichLanes over each frame's locations
+    tracking     collectData.pushFrameBatch
+    heatmap      heatmap.add_to_heatmap into a HeatmapAccumulator for every finished vehicle, then extract_heatmap
+    heatmap_dict the same with the original nested dict heatmap, for comparison
+    sink         mongointerface.add_count_mongo against fake in-memory collections
+    end_to_end   framer -> handler -> tracker -> add_count_mongo (fake collections)
+
+For every stage it reports frames/s, objects/s and p50/p99 per-frame latency as JSON, with the process's peak RSS
+so far: the stages share one process, so a stage's figure is the high-water mark of it and every stage before it.
+Captured files are split into MetadataStream packets; if they hold no frames, synthetic packets are used instead.
+No database is needed - nothing is written outside of the fake collections.
+
+    python benchmarks/ingest_benchmark.py [captured.xml ...] [--frames N] [--objects N] [--output results.json]
+"""
+
+import sys
+import json
+import time
+import argparse
+import contextlib
+import resource
+from collections import defaultdict, OrderedDict
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import numpy as np
+
+import mongointerface
+from metadataframer import MetadataFramer
+from metadatahandler import MetadataHandler
+from xmlmetadata import parseXml, parserBackends
+from pointSearch import whichLanes, setLanePairsFromDBList
+from collectData import pushFrameBatch, ObjectExpiry
+from heatmap import add_to_heatmap, extract_heatmap, HeatmapAccumulator, HeatmapRollup
+from tag_dispatch import build_packet, cameraInfo
+
+readerDirectory = Path(__file__).resolve().parent.parent
+defaultCaptures = [readerDirectory.parent / "oldstuff" / "output1.xml", readerDirectory / "test.xml"]
+chunkSize = 65536
+
+
+'''
+    Stand-in for a pymongo collection that only counts what it is given
+'''
+class FakeCollection():
+    def __init__(self, name):
+        self.name = name
+        self.documents = 0
+
+    def insert_one(self, document):
+        self.documents += 1
+
+    def insert_many(self, documents, ordered = True):
+        self.documents += len(documents)
+
+    def update_one(self, filter, update, upsert = False):
+        self.documents += 1
+
+    def bulk_write(self, operations, ordered = True):
+        self.documents += len(operations)
+
+
+def use_fake_collections():
+    fakes = {name: FakeCollection(name) for name in ("vehicles", "counts", "heatmaps", "heatmapTiles", "countRollups", "lastWrites")}
+    mongointerface.vehicleWriter.collection = fakes["vehicles"]
+    mongointerface.countWriter.collection = fakes["counts"]
+    mongointerface.heatmapCollection = fakes["heatmaps"]
+    mongointerface.heatmapTileCollection = fakes["heatmapTiles"]
+    mongointerface.countRollupCollection = fakes["countRollups"]
+    mongointerface.writeMarkerCollection = fakes["lastWrites"]
+    return fakes
+
+
+def new_bin():
+    return {
+        "counts": defaultdict(lambda: defaultdict(int)),
+        "speeds": defaultdict(lambda: defaultdict(float)),
+        "timestamp": 0,
+        "heatmap": HeatmapAccumulator()
+    }
+
+
+def peak_rss_megabytes():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize(latencies, frames, objects):
+    total = sum(latencies)
+    latencies = np.array(latencies) if len(latencies) > 0 else np.zeros(1)
+    return {
+        "frames": frames,
+        "objects": objects,
+        "seconds": round(total, 4),
+        "frames_per_second": round(frames / total, 1) if total > 0 else None,
+        "objects_per_second": round(objects / total, 1) if total > 0 else None,
+        "p50_frame_ms": round(float(np.percentile(latencies, 50)) * 1000, 4),
+        "p99_frame_ms": round(float(np.percentile(latencies, 99)) * 1000, 4),
+        "cumulative_peak_rss_mb": peak_rss_megabytes(),
+    }
+
+
+def load_packets(paths):
+    packets = []
+    for filePath in paths:
+        if Path(filePath).exists():
+            framer = MetadataFramer()
+            packets += [packet for packet in framer.feed(Path(filePath).read_bytes()) if b"Frame" in packet]
+    return packets
+
+
+'''
+    Synthetic 10 fps frames. Every object is replaced by a new one every objectLifetime frames so that vehicles finish
+'''
+def synthetic_packets(frameCount, objectCount, objectLifetime = 50):
+    start = datetime.fromisoformat("2025-10-06T18:55:21.053Z")
+    return [build_packet(start + timedelta(seconds=i / 10), objectCount, 1000 + (i // objectLifetime) * objectCount) for i in range(frameCount)]
+
+
+'''
+    Zones covering the area the packets' objects move through: a grid of rectangles over their bounding box
+'''
+def build_zones(batches, zoneCount = 20):
+    locations = np.concatenate([batch.locations() for batch in batches])
+    locations = locations[~np.isnan(locations).any(axis=1)]
+    if len(locations) == 0:
+        locations = np.array([[cameraInfo["coordinates"][0], cameraInfo["coordinates"][1]]])
+    minimum = locations.min(axis=0) - 1e-5
+    maximum = locations.max(axis=0) + 1e-5
+    columns = int(np.ceil(np.sqrt(zoneCount)))
+    rows = int(np.ceil(zoneCount / columns))
+    step = (maximum - minimum) / (rows, columns)
+    zones = []
+    for zoneIndex in range(zoneCount):
+        low = minimum + step * (zoneIndex // columns, zoneIndex % columns)
+        high = low + step
+        zones.append({"name": f"zone{zoneIndex}", "coordinates": [
+            {"lat": low[0], "lng": low[1]}, {"lat": high[0], "lng": low[1]}, {"lat": high[0], "lng": high[1]}, {"lat": low[0], "lng": high[1]}
+        ]})
+    return setLanePairsFromDBList(zones)
+
+
+'''
+    MetadataHandler with the tracker step swapped for collecting the frame's batch
+'''
+class ParseOnlyHandler(MetadataHandler):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batches = []
+
+    def push_frame_batch(self):
+        batch = self.frameBatch.build(self.timestamp)
+        batch.offset_locations(self.offset)
+        self.batches.append(batch)
+
+
+def bench_framing(stream):
+    framer = MetadataFramer()
+    latencies = []
+    frames = 0
+    for start in range(0, len(stream), chunkSize):
+        chunkStart = time.perf_counter()
+        frames += len(framer.feed(stream[start:start + chunkSize]))
+        latencies.append(time.perf_counter() - chunkStart)
+    # Per-frame latency for framing is the cost of the chunk spread over the frames it completed
+    perFrame = [sum(latencies) / max(frames, 1)] * frames
+    return summarize(perFrame, frames, 0)
+
+
+def bench_handler(packets):
+    handler = ParseOnlyHandler(cameraInfo, {}, dataPushFunction=None)
+    latencies = []
+    for packet in packets:
+        start = time.perf_counter()
+        handler.feed_packet(packet)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, len(handler.batches), sum(len(batch) for batch in handler.batches)), handler.batches
+
+
+def bench_parse_xml(packets, backend):
+    latencies = []
+    objects = 0
+    # parseXml prints the objects it drops, keep that out of the JSON on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        for packet in packets:
+            start = time.perf_counter()
+            frameObjects = parseXml(packet, whichLanes, {}, cameraInfo["name"], cameraInfo["coordinates"], backend=backend)
+            latencies.append(time.perf_counter() - start)
+            objects += len(frameObjects or [])
+    return summarize(latencies, len(packets), objects)
+
+
+def bench_zones(batches, lanes):
+    latencies = []
+    for batch in batches:
+        start = time.perf_counter()
+        batch.classify_zones(lanes)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, len(batches), sum(len(batch) for batch in batches))
+
+
+def bench_tracking(batches):
+    finished = []
+    frameIndex = 0
+    push = lambda roadObjectData, heatmapRollup, currentBin: finished.append((frameIndex, roadObjectData))
+    activeRoadObjects = {}
+    recentQueue = OrderedDict()
+    expiry = ObjectExpiry()
+    latencies = []
+    for frameIndex, batch in enumerate(batches):
+        start = time.perf_counter()
+        pushFrameBatch(batch, cameraInfo["name"], push, activeRoadObjects, recentQueue, new_bin(), [], expiry)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, len(batches), sum(len(batch) for batch in batches)), finished
+
+
+def group_by_frame(finished):
+    frames = defaultdict(list)
+    for frameIndex, roadObjectData in finished:
+        frames[frameIndex].append(roadObjectData)
+    return list(frames.values())
+
+
+def bench_heatmap(finishedFrames, heatmap):
+    latencies = []
+    for documents in finishedFrames:
+        start = time.perf_counter()
+        for roadObjectData in documents:
+            add_to_heatmap(heatmap, roadObjectData)
+        latencies.append(time.perf_counter() - start)
+    start = time.perf_counter()
+    extract_heatmap([heatmap])
+    latencies.append(time.perf_counter() - start)
+    result = summarize(latencies, len(finishedFrames), sum(len(documents) for documents in finishedFrames))
+    result["extract_ms"] = round(latencies[-1] * 1000, 4)
+    return result
+
+
+def bench_sink(finishedFrames):
+    fakes = use_fake_collections()
+    currentBin = new_bin()
+    heatmapRollup = HeatmapRollup()
+    latencies = []
+    for documents in finishedFrames:
+        start = time.perf_counter()
+        for roadObjectData in documents:
+            mongointerface.add_count_mongo(dict(roadObjectData, zones=list(roadObjectData["zones"])), heatmapRollup, currentBin)
+        latencies.append(time.perf_counter() - start)
+    mongointerface.vehicleWriter.flush()
+    mongointerface.countWriter.flush()
+    result = summarize(latencies, len(finishedFrames), sum(len(documents) for documents in finishedFrames))
+    result["documents_written"] = {name: fake.documents for name, fake in fakes.items()}
+    return result
+
+
+def bench_end_to_end(stream, lanes):
+    use_fake_collections()
+    handler = MetadataHandler(cameraInfo, lanes, dataPushFunction=mongointerface.add_count_mongo)
+    framer = MetadataFramer()
+    latencies = []
+    frames = 0
+    objects = 0
+    for start in range(0, len(stream), chunkSize):
+        for packet in framer.feed(stream[start:start + chunkSize]):
+            packetStart = time.perf_counter()
+            handler.feed_packet(packet)
+            latencies.append(time.perf_counter() - packetStart)
+            frames += 1
+            objects += packet.count(b"<tt:Object ")
+    return summarize(latencies, frames, objects)
+
+
+if __name__ == "__main__":
+    argumentParser = argparse.ArgumentParser(description="Offline ingest benchmark over captured metadata")
+    argumentParser.add_argument("captures", nargs="*", help="Captured metadata files (default: oldstuff/output1.xml and test.xml)")
+    argumentParser.add_argument("--frames", type=int, default=3000, help="Synthetic frames to use when the captures hold none")
+    argumentParser.add_argument("--objects", type=int, default=30, help="Objects per synthetic frame")
+    argumentParser.add_argument("--output", help="Write the JSON results to this file as well")
+    arguments = argumentParser.parse_args()
+
+    captures = arguments.captures or [str(path) for path in defaultCaptures]
+    packets = load_packets(captures)
+    source = {"captures": captures}
+    if len(packets) == 0:
+        packets = synthetic_packets(arguments.frames, arguments.objects)
+        source = {"synthetic_frames": arguments.frames, "objects_per_frame": arguments.objects}
+    stream = b"\n".join(packets)
+
+    results = {"source": source, "stages": {}}
+    stages = results["stages"]
+    stages["framing"] = bench_framing(stream)
+    stages["handler"], batches = bench_handler(packets)
+    for backend in parserBackends:
+        stages[f"parseXml_{backend}"] = bench_parse_xml(packets, backend)
+    lanes = build_zones(batches)
+    results["zones"] = len(lanes)
+    stages["zones"] = bench_zones(batches, lanes)
+    stages["tracking"], finished = bench_tracking(batches)
+    finishedFrames = group_by_frame(finished)
+    stages["heatmap"] = bench_heatmap(finishedFrames, HeatmapAccumulator())
+    stages["heatmap_dict"] = bench_heatmap(finishedFrames, {})
+    stages["sink"] = bench_sink(finishedFrames)
+    stages["end_to_end"] = bench_end_to_end(stream, lanes)
+    results["peak_rss_mb"] = peak_rss_megabytes()
+
+    output = json.dumps(results, indent=4)
+    print(output)
+    if arguments.output:
+        Path(arguments.output).write_text(output)
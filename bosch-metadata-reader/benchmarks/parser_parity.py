@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+parser_parity.py
+Checks that every xmlmetadata.parseXml backend returns the same frameObjects as the BeautifulSoup one,
+and times each backend on the same packets.
+Packets come from test.xml, any captured metadata files given on the command line (split into
+MetadataStream packets), and a set of synthetic packets covering the Class, ClassCandidate and VehicleInfo layouts.
+Exits with status 1 on any mismatch.
+
+    python benchmarks/parser_parity.py [captured.xml ...]
+"""
+
+import sys
+import json
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from xmlmetadata import parseXml, parserBackends
+from metadataframer import MetadataFramer
+from pointSearch import whichLanes, setLanePairsFromDBList
+
+readerDirectory = Path(__file__).resolve().parent.parent
+offset = (35.0, -120.0)
+lanes = setLanePairsFromDBList([
+    {"name": "North", "coordinates": [{"lat": 34.9, "lng": -120.1}, {"lat": 35.0, "lng": -120.1}, {"lat": 35.0, "lng": -119.9}, {"lat": 34.9, "lng": -119.9}]},
+])
+
+objectLayouts = [
+    # Class with a Type that has a Likelihood attribute, plus the Likelihood element the original parser reads
+    '<tt:Class><tt:Type Likelihood="0.98">Car</tt:Type><tt:Likelihood>0.98</tt:Likelihood></tt:Class>',
+    # ClassCandidate layout
+    '<tt:Class><tt:ClassCandidate><tt:Type>Human</tt:Type><tt:Likelihood>0.7</tt:Likelihood></tt:ClassCandidate></tt:Class>',
+    # VehicleInfo layout
+    '<tt:VehicleInfo><tt:Type Likelihood="0.5">Truck</tt:Type></tt:VehicleInfo>',
+    # Class without a Likelihood element - both backends drop this object
+    '<tt:Class><tt:Type Likelihood="0.9">Bike</tt:Type></tt:Class>',
+    # No type information at all
+    '',
+]
+
+
+def synthetic_packets():
+    packets = []
+    for frameIndex in range(20):
+        objects = []
+        for objectIndex, layout in enumerate(objectLayouts):
+            geo = '' if objectIndex == 4 else f'<tt:GeoLocation lon="0.0{objectIndex}" lat="-0.0{frameIndex % 10}" elevation="-10"/>'
+            speed = '' if objectIndex == 2 else f'<tt:Behaviour><tt:Speed>{frameIndex}.5</tt:Speed></tt:Behaviour>'
+            objects.append(
+                f'<tt:Object ObjectId="{frameIndex * 10 + objectIndex}"><tt:Appearance><tt:Shape>'
+                '<tt:BoundingBox left="0.26" top="0.82" right="0.42" bottom="0.68"/><tt:CenterOfGravity x="0.34" y="0.75"/>'
+                f'</tt:Shape>{layout}{geo}</tt:Appearance>{speed}</tt:Object>'
+            )
+        packets.append(
+            '<?xml version="1.0" encoding="UTF-8"?>\n<tt:MetadataStream xmlns:tt="http://www.onvif.org/ver10/schema"><tt:VideoAnalytics>'
+            f'<tt:Frame UtcTime="2025-10-06T18:55:{frameIndex:02d}.053Z">{"".join(objects)}</tt:Frame></tt:VideoAnalytics></tt:MetadataStream>'
+        )
+    return packets
+
+
+def captured_packets(filePath):
+    framer = MetadataFramer()
+    return [packet.decode("utf-8") for packet in framer.feed(Path(filePath).read_bytes())]
+
+
+def describe(frameObjects):
+    if frameObjects == None: return None
+    return [(roadObject.id, roadObject.boundingBox, roadObject.path, roadObject.get_data()) for roadObject in frameObjects]
+
+
+def parse_all(packets, backend):
+    start = time.perf_counter()
+    results = [parseXml(packet, whichLanes, lanes, "parity", offset, backend=backend) for packet in packets]
+    return results, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    sources = {"test.xml": [(readerDirectory / "test.xml").read_text()], "synthetic": synthetic_packets()}
+    for filePath in sys.argv[1:]:
+        sources[filePath] = captured_packets(filePath)
+
+    report = {}
+    mismatches = 0
+    for sourceName, packets in sources.items():
+        expected, expectedTime = parse_all(packets, "bs4")
+        report[sourceName] = {"packets": len(packets), "bs4_seconds": round(expectedTime, 4)}
+        for backend in parserBackends:
+            if backend == "bs4": continue
+            results, elapsed = parse_all(packets, backend)
+            matching = sum(describe(a) == describe(b) for a, b in zip(expected, results))
+            mismatches += len(packets) - matching
+            report[sourceName][f"{backend}_seconds"] = round(elapsed, 4)
+            report[sourceName][f"{backend}_matching_packets"] = matching
+    print(json.dumps(report, indent=4))
+    sys.exit(1 if mismatches > 0 else 0)
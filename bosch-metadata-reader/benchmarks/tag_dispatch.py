@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+tag_dispatch.py
+Microbenchmark for the streaming XML handler: elements per second through the original
+split("}") + if/elif handler and through MetadataHandler's precompiled dispatch tables.
+Only the handler is timed - each packet is parsed into its event list beforehand.
+
+    python benchmarks/tag_dispatch.py [packets] [objects per frame]
+"""
+
+import sys
+import json
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from metadatahandler import MetadataHandler, speedFactor
+from framebatch import FrameBatchBuilder
+
+cameraInfo = {"name": "benchmark", "coordinates": [35.0, -120.0]}
+
+
+def build_packet(frameTime, objectCount, firstObjectId = 1000):
+    objects = []
+    for objectId in range(objectCount):
+        points = "".join(f'<tt:Point x="0.{objectId}{i}" y="-0.{i}{objectId}"/>' for i in range(4))
+        objects.append(
+            f'<tt:Object ObjectId="{firstObjectId + objectId}"><tt:Appearance><tt:Shape>'
+            f'<tt:BoundingBox left="0.26" top="0.82" right="0.42" bottom="0.68"/><tt:CenterOfGravity x="0.34" y="0.75"/>'
+            f'<tt:Polygon>{points}</tt:Polygon></tt:Shape>'
+            f'<tt:Class><tt:ClassCandidate><tt:Type>Car</tt:Type><tt:Likelihood>0.98</tt:Likelihood></tt:ClassCandidate>'
+            f'<tt:Type Likelihood="0.98">Car</tt:Type></tt:Class>'
+            f'<tt:GeoLocation lon="0.000{objectId}36" lat="-0.000{objectId}24" elevation="-10"/></tt:Appearance>'
+            f'<tt:Behaviour><tt:Speed>12.84</tt:Speed></tt:Behaviour></tt:Object>'
+        )
+    return (
+        '<tt:MetadataStream xmlns:tt="http://www.onvif.org/ver10/schema"><tt:VideoAnalytics>'
+        f'<tt:Frame UtcTime="{frameTime.isoformat().replace("+00:00", "Z")}">{"".join(objects)}</tt:Frame>'
+        '</tt:VideoAnalytics></tt:MetadataStream>'
+    ).encode()
+
+
+'''
+    The handler as it was before the dispatch tables, filling the same FrameBatchBuilder so both do the same work.
+    Fields are read on end events here too - the original cleared every element on its start event.
+'''
+class SplitHandler():
+    def __init__(self):
+        self.frameBatch = FrameBatchBuilder()
+        self.openObject = False
+        self.timestamp = None
+
+    def handle(self, event, elem):
+        tag = elem.tag.split("}")[1]
+        if tag == "Frame":
+            if event == "start":
+                self.timestamp = datetime.fromisoformat(elem.attrib['UtcTime'])
+            elif event == "end":
+                self.frameBatch.build(self.timestamp)
+        elif tag == "Object":
+            if event == "start":
+                self.openObject = True
+                self.frameBatch.add_object(elem.attrib["ObjectId"])
+            elif event == "end":
+                self.openObject = False
+        elif self.openObject == True and event == "end":
+            if tag == "GeoLocation":
+                self.frameBatch.setLatLon(float(elem.attrib["lat"]), float(elem.attrib["lon"]))
+            elif tag == "Point":
+                pass
+            elif tag == "Type":
+                if 'Likelihood' in elem.attrib and elem.text != None:
+                    self.frameBatch.setDetectedType(elem.text)
+                    self.frameBatch.setDetectionCertainty(float(elem.attrib['Likelihood']))
+            elif tag == "Speed":
+                self.frameBatch.setSpeed(float(elem.text) * speedFactor)
+            else:
+                pass
+
+
+'''
+    MetadataHandler with the tracker step stubbed out, so only the element handling is measured
+'''
+class DispatchHandler(MetadataHandler):
+    def push_frame_batch(self):
+        self.frameBatch.build(self.timestamp)
+
+
+def get_events(packet):
+    parser = ET.XMLPullParser(['start', 'end'])
+    parser.feed(packet)
+    return list(parser.read_events())
+
+
+def run(handle, packets):
+    elementCount = 0
+    elapsed = 0.0
+    for packet in packets:
+        events = get_events(packet)
+        start = time.perf_counter()
+        for event, elem in events:
+            handle(event, elem)
+        elapsed += time.perf_counter() - start
+        elementCount += len(events) // 2
+    return elementCount / elapsed
+
+
+if __name__ == "__main__":
+    packetCount = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    objectCount = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    start = datetime.fromisoformat("2025-10-06T18:55:21.053Z")
+    packets = [build_packet(start + timedelta(seconds=i / 10), objectCount) for i in range(packetCount)]
+
+    splitRate = run(SplitHandler().handle, packets)
+    dispatchRate = run(DispatchHandler(cameraInfo, {}, dataPushFunction=None).handle, packets)
+    print(json.dumps({
+        "packets": packetCount,
+        "objects_per_frame": objectCount,
+        "split_handler_elements_per_second": round(splitRate),
+        "dispatch_handler_elements_per_second": round(dispatchRate),
+        "speedup": round(dispatchRate / splitRate, 2)
+    }, indent=4))
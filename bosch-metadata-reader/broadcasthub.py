@@ -0,0 +1,129 @@
+'''
+    Live coordinate broadcast hub: camera readers publish their latest coordinate set, dashboards subscribe.
+    Publishers connect to /publish/<camera name> and send JSON coordinate sets as often as they like. Only the latest
+    one per camera is kept. Every tick, the cameras that changed since the last tick are sent to every subscriber as
+    {"cameras": {camera name: coordinate set}}. A camera whose publisher disconnects is sent once as an empty list.
+    Subscribers connect to /subscribe, or /subscribe?cameras=a,b for only some cameras.
+    Each subscriber has a one message slot: a slow client is sent the newest update once it is ready again and the
+    updates in between are dropped, so it never holds up the tick, the other clients, or a camera.
+
+    python broadcasthub.py [port]
+'''
+import sys
+import json
+import asyncio
+from urllib.parse import urlparse, parse_qs, unquote
+
+from websockets.asyncio.server import serve
+from websockets.exceptions import ConnectionClosed
+
+hubPort = 8001
+# Updates per second sent to subscribers
+tickRate = 8
+
+class Subscriber():
+    def __init__(self, connection, cameras = None):
+        self.connection = connection
+        # None for every camera
+        self.cameras = cameras
+        self.pending = None
+        self.ready = asyncio.Event()
+        self.dropped = 0
+
+    '''
+        Replace whatever is waiting to be sent. Never waits on the client
+    '''
+    def offer(self, snapshots):
+        if self.cameras != None:
+            snapshots = {camera: snapshot for camera, snapshot in snapshots.items() if camera in self.cameras}
+            if len(snapshots) == 0: return
+        if self.pending != None:
+            self.dropped += 1
+            # Cameras missing from the newer update still need their last snapshot
+            snapshots = dict(self.pending, **snapshots)
+        self.pending = snapshots
+        self.ready.set()
+
+    async def send_loop(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            snapshots, self.pending = self.pending, None
+            # The snapshots are still the publishers' JSON text, they are only put together here
+            try:
+                await self.connection.send('{"cameras": {' + ", ".join(f"{json.dumps(camera)}: {snapshot}" for camera, snapshot in snapshots.items()) + '}}')
+            except ConnectionClosed:
+                return
+
+class BroadcastHub():
+    def __init__(self, tickRate = tickRate):
+        self.tickSeconds = 1 / tickRate
+        # Latest coordinate set of every camera, as received, and the cameras that changed since the last tick
+        self.snapshots = {}
+        self.changed = set()
+        self.subscribers = set()
+
+    async def handle(self, connection):
+        url = urlparse(connection.request.path)
+        if url.path.startswith("/publish/"):
+            # Publishers quote the camera name, see broadcastlatlon.py
+            await self.handle_publisher(connection, unquote(url.path[len("/publish/"):]))
+        elif url.path == "/subscribe":
+            cameras = parse_qs(url.query).get("cameras")
+            await self.handle_subscriber(connection, set(",".join(cameras).split(",")) if cameras else None)
+        else:
+            await connection.close(1008, "Unknown path")
+
+    async def handle_publisher(self, connection, camera):
+        print(f"Publisher connected for {camera}")
+        try:
+            async for message in connection:
+                try:
+                    json.loads(message)
+                except ValueError:
+                    continue
+                self.snapshots[camera] = message
+                self.changed.add(camera)
+        except ConnectionClosed:
+            pass
+        finally:
+            print(f"Publisher for {camera} disconnected")
+            self.snapshots[camera] = "[]"
+            self.changed.add(camera)
+
+    async def handle_subscriber(self, connection, cameras):
+        subscriber = Subscriber(connection, cameras)
+        self.subscribers.add(subscriber)
+        # Start the client off with everything there is
+        subscriber.offer({camera: self.snapshots[camera] for camera in self.snapshots})
+        sender = asyncio.create_task(subscriber.send_loop())
+        try:
+            # Subscribers have nothing to say, this just waits for them to leave
+            await connection.wait_closed()
+        finally:
+            self.subscribers.discard(subscriber)
+            sender.cancel()
+
+    async def tick(self):
+        while True:
+            await asyncio.sleep(self.tickSeconds)
+            if len(self.changed) == 0: continue
+            snapshots = {camera: self.snapshots[camera] for camera in self.changed}
+            self.changed = set()
+            # Cameras that went away were just sent their empty list
+            for camera, snapshot in snapshots.items():
+                if snapshot == "[]":
+                    self.snapshots.pop(camera, None)
+            for subscriber in list(self.subscribers):
+                subscriber.offer(snapshots)
+
+    async def run(self, port = hubPort):
+        async with serve(self.handle, "", port, max_queue=1):
+            print(f"Broadcast hub on port {port}")
+            await self.tick()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(BroadcastHub().run(int(sys.argv[1]) if len(sys.argv) > 1 else hubPort))
+    except KeyboardInterrupt:
+        pass
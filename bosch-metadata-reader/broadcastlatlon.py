@@ -1,47 +1,98 @@
-import asyncio
-from websockets.sync.client import connect
-import datetime
 import json
+import time
+import threading
+from urllib.parse import quote
+from websockets.sync.client import connect
+from websockets.exceptions import WebSocketException
 
-websocket = None
-# Dictionary of coordinates. Each entry corresponds to a camera, is broken down and sent thru the websocket
-coordinatesDict = {}
-lastSentTime = 0
+'''
+    Live coordinates for the broadcast hub (see broadcasthub.py). Every camera gets a publisher thread with a one
+    coordinate set slot: the parse loop only ever replaces what is in the slot, it never waits on the socket.
+    The thread sends the newest set at most sendRateFPS times a second and reconnects on its own when the hub goes away
+'''
+hubPort = 8001
 # The rate, per second, of the number of sends of location data the program should be sending
 sendRateFPS = 8
+firstBackoff = 1
+maxBackoff = 30
+
+class LatLonPublisher():
+    def __init__(self, port, cameraName):
+        # Camera names can have spaces and slashes
+        self.url = f"ws://localhost:{port}/publish/{quote(cameraName, safe='')}"
+        self.cameraName = cameraName
+        self.latest = None
+        self.condition = threading.Condition()
+        self.connected = False
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, daemon=True, name=f"publisher-{cameraName}")
+        self.thread.start()
+
+    '''
+        Replace whatever is waiting to be sent. Never blocks
+    '''
+    def publish(self, data):
+        with self.condition:
+            self.latest = data
+            self.condition.notify()
+
+    def next_data(self):
+        with self.condition:
+            while self.latest == None and not self.closed:
+                self.condition.wait()
+            data, self.latest = self.latest, None
+            return data
+
+    def run(self):
+        backoff = firstBackoff
+        while not self.closed:
+            try:
+                with connect(self.url, open_timeout=5) as websocket:
+                    self.connected = True
+                    backoff = firstBackoff
+                    print(f"Coordinate livestream connected for {self.cameraName}")
+                    self.send_loop(websocket)
+            except (OSError, WebSocketException) as error:
+                if self.connected:
+                    print(f"Coordinate livestream lost for {self.cameraName}", error)
+            self.connected = False
+            if self.closed: return
+            # Whatever was published meanwhile is stale by the time the hub is back
+            with self.condition:
+                self.latest = None
+                self.condition.wait(backoff)
+            backoff = min(backoff * 2, maxBackoff)
+
+    def send_loop(self, websocket):
+        lastSentTime = 0
+        while not self.closed:
+            data = self.next_data()
+            if data == None: return
+            websocket.send(json.dumps(data))
+            lastSentTime = time.monotonic()
+            # Sets published while waiting out the rate replace each other, only the newest is sent
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed, timeout=max(0, lastSentTime + 1 / sendRateFPS - time.monotonic()))
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
 
+port = None
+publishers = {}
 
-def connect_to_server(portNumber):
-    global websocket
-    try:
-        websocket = connect(f"ws://localhost:{portNumber}")
-    except:
-        print("Failed to connect to interface")
+def connect_to_server(portNumber = hubPort):
+    global port
+    port = portNumber
 
-def is_ws_connected():
-    try:
-        websocket.recv()
-        return websocket.connected
-    except:
-        return False
+def is_ws_connected(cameraName = None):
+    if cameraName != None:
+        return cameraName in publishers and publishers[cameraName].connected
+    return any(publisher.connected for publisher in publishers.values())
 
 def send_websocket_data(data, cameraName):
-    global lastSentTime, sendRate
-    if websocket == None: return
-    if lastSentTime == 0:
-        lastSentTime = datetime.datetime.now()
-    # Add the coordinates to the dictionary of cameras, replacing if necessary
-
-    # Check the amount of time since the last send. if it's greater than the rate, send again
-    timeDifference = datetime.datetime.now() - lastSentTime
-    if timeDifference > datetime.timedelta(seconds= (1 / sendRateFPS)):
-        # print(json.dumps(accumulate_points()))
-        websocket.send(json.dumps(data))
-        lastSentTime = datetime.datetime.now()
-    # if (is_ws_connected()):
-
-def accumulate_points():
-    outputArray = []
-    for key in coordinatesDict:
-        outputArray += coordinatesDict[key]
-    return outputArray
\ No newline at end of file
+    if port == None: return
+    if cameraName not in publishers:
+        publishers[cameraName] = LatLonPublisher(port, cameraName)
+    publishers[cameraName].publish(data)
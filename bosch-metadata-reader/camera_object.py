@@ -1,4 +1,5 @@
 from datetime import datetime
+from array import array
 
 # Camera object class, stores and manages data for individual objects coming off of the camera
 class CameraObject():
@@ -12,6 +13,8 @@ class CameraObject():
             self.timestamp = timestamp
         # TODO: Include support for other timestamp types?
         else: raise ValueError
+        # The newest timestamp the object was seen at, used to expire objects that have left the view
+        self.lastSeen = self.timestamp
 
         # The number of updates to the object's attributes: necessary for computing running averages
         self.numberOfUpdates = 1
@@ -28,6 +31,8 @@ class CameraObject():
         # The history of zones that the object has appeared in. NOTE: This was preiously called lane history,
         # the two might still be used interchangeably in some parts of the code
         self.zoneHistory = []
+        # The version of the zone set the object was last zoned against (see pointSearch.zone_version), None if unknown
+        self.zoneVersion = None
 
         # The object's speed, in mph
         self.speed = speed
@@ -67,10 +72,14 @@ class CameraObject():
 
         # TODO: This is not working - fix?
         self.timeElapsed = newObject.timestamp - self.timestamp
+        if newObject.lastSeen > self.lastSeen:
+            self.lastSeen = newObject.lastSeen
 
         self.speed = self.get_running_average(self.speed, newObject.speed)
 
         self.combine_zone_history(newObject.zoneHistory)
+        if newObject.zoneVersion != None:
+            self.zoneVersion = newObject.zoneVersion
 
         self.path += newObject.path
         # TODO: Breaking bug
@@ -132,7 +141,10 @@ class CameraObject():
     # If there is no zone history, the new zone is added to the list
     # If there is zone history but it is only "unknown", "unknown" is removed and the new value is added
     # If there is other zone history and the zone being added is not in the list and is also not unknown, the value is added
-    def add_lane(self, zone):
+    # zoneVersion is the version of the zone set the zone came from
+    def add_lane(self, zone, zoneVersion = None):
+        if zoneVersion != None:
+            self.zoneVersion = zoneVersion
         if zone != "Unknown" and zone not in self.zoneHistory:
             self.zoneHistory.append(zone)
 
@@ -155,7 +167,7 @@ class CameraObject():
             self.detectedType = self.get_running_average(self.detectedType, objectData["type"])
             self.add_lane(objectData["lane"])
             self.speed = self.get_running_average(self.speed, objectData["speed"])
-        elif type(objectData) == CameraObject:
+        elif isinstance(objectData, cameraObjectTypes):
             self.merge_object(objectData)
 
     '''
@@ -168,6 +180,7 @@ class CameraObject():
         dataDict["detected_type"] = self.detectedType
         dataDict["detection_certainty"] = self.detectionCertainty
         dataDict["zones"] = self.zoneHistory
+        dataDict["zoneVersion"] = self.zoneVersion
         dataDict["speed"] = self.speed
         dataDict["mapPath"] = self.mapPath
         return dataDict
@@ -176,3 +189,152 @@ class CameraObject():
     def __str__(self):
         return f"{self.id}: {self.timestamp}, {self.detectedType}, zones {self.zoneHistory}, {self.speed}, Updated {self.numberOfUpdates} times"
 
+
+'''
+    Memory-compact camera object for long-lived tracked objects (parked cars, long queues).
+    Uses __slots__ instead of a per-object __dict__, and keeps path and mapPath as flat array('d') buffers of
+    interleaved coordinates instead of lists of tuples. The public methods match CameraObject, and path and mapPath
+    are still readable as lists of tuples, so the two classes can be merged into each other.
+'''
+class CompactCameraObject():
+    __slots__ = (
+        "id", "timestamp", "lastSeen", "numberOfUpdates", "modified", "timeElapsed", "zoneHistory", "zoneVersion", "speed",
+        "boundingBox", "centerOfGravity", "detectedType", "detectionCertainty", "pathBuffer", "mapPathBuffer"
+    )
+
+    def __init__(self, id, timestamp, boundingBox = None, centerOfGravity = None, detectedType = "None", detectionCertainty = 0.0, speed = None, objectCenter = None):
+        self.id = id
+        if type(timestamp) == str:
+            self.timestamp = datetime.fromisoformat(timestamp)
+        elif type(timestamp) == datetime:
+            self.timestamp = timestamp
+        else: raise ValueError
+        self.lastSeen = self.timestamp
+
+        self.numberOfUpdates = 1
+        self.modified = 1
+        # x0, y0, x1, y1, ... - see path
+        self.pathBuffer = array('d')
+        self.timeElapsed = 0
+        self.zoneHistory = []
+        self.zoneVersion = None
+        self.speed = speed
+
+        if boundingBox != None:
+            self.set_bounding_box_xml(boundingBox)
+        else:
+            self.boundingBox = (0,0,0,0)
+
+        if centerOfGravity != None:
+            self.set_centerofgravity_xml(centerOfGravity)
+        else:
+            self.centerOfGravity = (0,0)
+
+        self.detectedType = detectedType
+        self.detectionCertainty = detectionCertainty
+
+        # lat0, lon0, lat1, lon1, ... - see mapPath
+        self.mapPathBuffer = array('d')
+        if objectCenter != None and objectCenter[0] != None and objectCenter[1] != None:
+            self.mapPathBuffer.extend(objectCenter)
+
+    @property
+    def path(self):
+        return get_pairs(self.pathBuffer)
+
+    @property
+    def mapPath(self):
+        return get_pairs(self.mapPathBuffer)
+
+    '''
+        Same as CameraObject.merge_object, copying the coordinate buffers directly when the new object is also compact
+    '''
+    def merge_object(self, newObject):
+        self.numberOfUpdates += 1
+        self.detectedType = newObject.detectedType
+        self.detectionCertainty = self.get_running_average(self.detectionCertainty, newObject.detectionCertainty)
+
+        self.timeElapsed = newObject.timestamp - self.timestamp
+        if newObject.lastSeen > self.lastSeen:
+            self.lastSeen = newObject.lastSeen
+
+        self.speed = self.get_running_average(self.speed, newObject.speed)
+
+        self.combine_zone_history(newObject.zoneHistory)
+        if newObject.zoneVersion != None:
+            self.zoneVersion = newObject.zoneVersion
+
+        newPath, newMapPath = get_buffers(newObject)
+        self.pathBuffer.extend(newPath)
+        if len(newMapPath) > 0 and (len(self.mapPathBuffer) == 0 or self.mapPathBuffer[-2:] != newMapPath[:2]):
+            self.mapPathBuffer.extend(newMapPath)
+
+    '''
+        Same as add_data with a single-update object, but takes one row of a FrameBatch as plain values
+        so that no object has to be built for the detection. location and center are None when missing
+    '''
+    def add_detection(self, timestamp, detectedType, detectionCertainty, speed, zone, location, center, zoneVersion = None):
+        # add_data and merge_object each count an update
+        self.numberOfUpdates += 2
+        self.modified = 1
+        self.detectedType = detectedType
+        self.detectionCertainty = self.get_running_average(self.detectionCertainty, detectionCertainty)
+
+        self.timeElapsed = timestamp - self.timestamp
+        if timestamp > self.lastSeen:
+            self.lastSeen = timestamp
+
+        self.speed = self.get_running_average(self.speed, speed)
+
+        self.add_lane(zone, zoneVersion)
+
+        if center != None:
+            self.pathBuffer.extend(center)
+        if location != None and (len(self.mapPathBuffer) == 0 or self.mapPathBuffer[-2] != location[0] or self.mapPathBuffer[-1] != location[1]):
+            self.mapPathBuffer.extend(location)
+
+    def set_centerofgravity_xml(self, centerOfGravityObject):
+        self.centerOfGravity = (float(centerOfGravityObject.get("x")), float(centerOfGravityObject.get("y")))
+        self.pathBuffer.extend(self.centerOfGravity)
+
+    def setLatLon(self, lat, lon):
+        self.mapPathBuffer.append(lat)
+        self.mapPathBuffer.append(lon)
+
+    def getCurrentLocation(self):
+        if len(self.mapPathBuffer) == 0:
+            return None
+        return (self.mapPathBuffer[-2], self.mapPathBuffer[-1])
+
+    # The rest of the methods do not touch the coordinate storage and are shared with CameraObject
+    get_running_average = CameraObject.get_running_average
+    set_bounding_box_xml = CameraObject.set_bounding_box_xml
+    setDetectedType = CameraObject.setDetectedType
+    getDetectedType = CameraObject.getDetectedType
+    setDetectionCertainty = CameraObject.setDetectionCertainty
+    getDetectionCertainty = CameraObject.getDetectionCertainty
+    setSpeed = CameraObject.setSpeed
+    getSpeed = CameraObject.getSpeed
+    getCurrentZone = CameraObject.getCurrentZone
+    add_lane = CameraObject.add_lane
+    combine_zone_history = CameraObject.combine_zone_history
+    add_data = CameraObject.add_data
+    get_data = CameraObject.get_data
+    __str__ = CameraObject.__str__
+
+cameraObjectTypes = (CameraObject, CompactCameraObject)
+
+def get_pairs(buffer):
+    return list(zip(buffer[0::2], buffer[1::2]))
+
+'''
+    The path and mapPath of either kind of camera object as flat array('d') buffers
+'''
+def get_buffers(cameraObject):
+    if isinstance(cameraObject, CompactCameraObject):
+        return cameraObject.pathBuffer, cameraObject.mapPathBuffer
+    path = array('d')
+    for point in cameraObject.path: path.extend(point)
+    mapPath = array('d')
+    for point in cameraObject.mapPath: mapPath.extend(point)
+    return path, mapPath
@@ -0,0 +1,142 @@
+import os
+import json
+import time
+import threading
+
+import mongointerface
+from pointSearch import zone_version
+
+'''
+    Camera configuration cache: keeps a local JSON snapshot of the cameras collection (urls, coordinates, zones),
+    so processing starts from the snapshot right away and does not depend on the database being up at boot.
+    A background thread refreshes it from the database every ttlSeconds. A failed refresh keeps the last snapshot.
+    Only a first start with no snapshot at all, or one that asks for a camera the snapshot does not have or whose
+    snapshot is past its TTL, has to wait for the database.
+    watch_zones registers for zone edits and watch_cameras for new cameras: refreshes are also how a running reader
+    picks up changed zones and cameras added to the collection.
+'''
+class CameraCache():
+    def __init__(self, snapshotPath = "cameras.snapshot.json", ttlSeconds = 300, loadCameras = mongointerface.get_camera_data):
+        self.snapshotPath = snapshotPath
+        self.ttlSeconds = ttlSeconds
+        self.loadCameras = loadCameras
+        self.cameras = {}
+        # Wall clock time of the last successful database read
+        self.refreshedAt = 0
+        self.lock = threading.Lock()
+        # (camera name, callback(zones)) for every zone watcher, and callback(camera_info) for every new camera watcher
+        self.zoneWatchers = []
+        self.cameraWatchers = []
+        self.closed = threading.Event()
+        if not self.load_snapshot():
+            self.refresh()
+        self.refreshThread = threading.Thread(target=self.refresh_on_ttl, daemon=True)
+        self.refreshThread.start()
+
+    '''
+        A camera's config, read from the database first if the snapshot does not have it or is past its TTL.
+        None if the database does not have it either, or can not be read and the snapshot does not have it
+    '''
+    def get_camera(self, name):
+        with self.lock:
+            camera = self.cameras.get(name)
+        if camera == None or self.is_stale():
+            self.refresh()
+            with self.lock:
+                camera = self.cameras.get(name)
+        return camera
+
+    # Every camera, from the database first if the snapshot is past its TTL
+    def get_cameras(self):
+        if self.is_stale():
+            self.refresh()
+        with self.lock:
+            return list(self.cameras.values())
+
+    def is_stale(self):
+        return time.time() - self.refreshedAt >= self.ttlSeconds
+
+    def load_snapshot(self):
+        try:
+            with open(self.snapshotPath) as snapshotFile:
+                snapshot = json.load(snapshotFile)
+        except (OSError, ValueError):
+            return False
+        self.set_cameras(snapshot["cameras"], snapshot["refreshedAt"])
+        return True
+
+    '''
+        Read the cameras from the database and write a new snapshot. Returns False if the database could not be read
+    '''
+    def refresh(self):
+        try:
+            cameras = self.loadCameras()
+        except Exception as error:
+            print("Camera config refresh failed, keeping the snapshot", error)
+            return False
+        # Through json so the cache holds exactly what the snapshot holds (the _id ObjectIds become strings)
+        cameras = json.loads(json.dumps(cameras, default=str))
+        refreshedAt = time.time()
+        self.set_cameras(cameras, refreshedAt)
+        self.write_snapshot(cameras, refreshedAt)
+        return True
+
+    def set_cameras(self, cameras, refreshedAt):
+        with self.lock:
+            previousCameras = self.cameras
+            self.cameras = {camera["name"]: camera for camera in cameras}
+            self.refreshedAt = refreshedAt
+        for name in self.cameras:
+            if name in previousCameras: continue
+            for callback in self.cameraWatchers:
+                try:
+                    callback(self.cameras[name])
+                except Exception as error:
+                    print(f"Adding {name} failed", error)
+        for name, callback in self.zoneWatchers:
+            camera = self.cameras.get(name)
+            if camera == None or name not in previousCameras: continue
+            if zone_version(camera["zones"]) == zone_version(previousCameras[name]["zones"]): continue
+            try:
+                callback(camera["zones"])
+            except Exception as error:
+                print(f"Zone update for {name} failed", error)
+
+    '''
+        Call callback(zones) from the refresh thread whenever a refresh finds the camera's zones changed.
+        Slow work like building the zone index belongs in the callback, it stays off of the parsing thread
+    '''
+    def watch_zones(self, name, callback):
+        self.zoneWatchers.append((name, callback))
+
+    '''
+        Call callback(camera_info) from the refresh thread for every camera that a refresh finds for the first time
+    '''
+    def watch_cameras(self, callback):
+        self.cameraWatchers.append(callback)
+
+    def unwatch_zones(self, name):
+        self.zoneWatchers = [watcher for watcher in self.zoneWatchers if watcher[0] != name]
+
+    def write_snapshot(self, cameras, refreshedAt):
+        # Written next to the snapshot and renamed over it, so readers only ever see a whole snapshot
+        # Each process gets its own temporary file, several readers can share one snapshot
+        temporaryPath = f"{self.snapshotPath}.{os.getpid()}.tmp"
+        try:
+            with open(temporaryPath, "w") as snapshotFile:
+                json.dump({"refreshedAt": refreshedAt, "cameras": cameras}, snapshotFile)
+            os.replace(temporaryPath, self.snapshotPath)
+        except OSError as error:
+            print("Could not write the camera snapshot", error)
+
+    def refresh_on_ttl(self):
+        while True:
+            # A stale snapshot from the last run is refreshed straight away
+            waitSeconds = max(0, self.refreshedAt + self.ttlSeconds - time.time())
+            if self.closed.wait(waitSeconds): return
+            if not self.refresh():
+                # Retry sooner while the database is down, the snapshot is still serving
+                if self.closed.wait(min(self.ttlSeconds, 30)): return
+
+    def close(self):
+        self.closed.set()
@@ -1,11 +1,53 @@
 from typing import Dict
-from camera_object import CameraObject
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import heapq
+import itertools
+import numpy as np
+from camera_object import CameraObject, CompactCameraObject, cameraObjectTypes
 
 # Two data structures:
 # One with the active objects(data existed in the last push, data exists in this push)
-# One with past objects(FIFO queue), upon the addition of a new object, the last object is pushed to the database
+# One with past objects(FIFO queue keyed by object id), upon the addition of a new object, the last object is pushed to the database.
+# The recent queue is an OrderedDict so that looking up, reviving and evicting the oldest object are all O(1)
 recentQueueThreshold = 20
 
+'''
+    Expiry scheduler for tracked objects, a min-heap of (deadline, sequence, object id, stage) keyed on each object's last seen UtcTime.
+    Stage "active": the object moves to the recent queue once it has not been seen for idleTimeout.
+    Stage "recent": the object is pushed to the database once it has not been seen for finishTimeout.
+    Each object only has one live entry per stage. Entries are checked lazily when they come due: an object that was seen
+    again in the meantime is rescheduled instead of expired, so per-frame work only depends on the objects that come due
+'''
+class ObjectExpiry():
+    def __init__(self, idleTimeout = timedelta(seconds=1), finishTimeout = timedelta(seconds=5)):
+        self.idleTimeout = idleTimeout
+        self.finishTimeout = finishTimeout
+        self.heap = []
+        # Tie breaker so that the heap never has to compare object ids
+        self.sequence = itertools.count()
+
+    def schedule(self, objectId, deadline, stage = "active"):
+        heapq.heappush(self.heap, (deadline, next(self.sequence), objectId, stage))
+
+    def pop_due(self, now: datetime):
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            deadline, _, objectId, stage = heapq.heappop(self.heap)
+            yield objectId, stage
+
+    def __len__(self):
+        return len(self.heap)
+
+# Expiries for callers that do not pass one, one per activeRoadObjects dict: {id(activeRoadObjects): (activeRoadObjects, expiry)}.
+# The dict is kept with its expiry so that its id stays its own. Callers that come and go should pass their own expiry
+defaultExpiries = {}
+
+def get_default_expiry(activeRoadObjects):
+    entry = defaultExpiries.get(id(activeRoadObjects))
+    if entry == None:
+        entry = defaultExpiries[id(activeRoadObjects)] = (activeRoadObjects, ObjectExpiry())
+    return entry[1]
+
 '''
     data_push_function: The function to send the data to a database. Defaults to the standard function
     To the data push, it returns a function containing:
@@ -16,8 +58,12 @@ recentQueueThreshold = 20
         - object certainty
         - zone #
         - speed
+    expiry: The ObjectExpiry that decides when objects leave the active objects and the recent queue. Defaults to one kept for activeRoadObjects
+    frameTime: The UtcTime of the frame. Defaults to the newest timestamp in objects, pass it so empty frames still expire objects
 '''
-def pushObjectData(objects, location, data_push_function, activeRoadObjects, recentQueue, currentBin, total_heatmaps):
+def pushObjectData(objects, location, data_push_function, activeRoadObjects, recentQueue: OrderedDict, currentBin, heatmapRollup, expiry: ObjectExpiry = None, frameTime: datetime = None):
+    if expiry == None:
+        expiry = get_default_expiry(activeRoadObjects)
     for roadObject in objects:
         searchID = str(roadObject["id"]) if type(roadObject) == dict else roadObject.id
 
@@ -29,36 +75,96 @@ def pushObjectData(objects, location, data_push_function, activeRoadObjects, rec
         else:
             # First check the recent queue to see if they are there. If they are, re-add them to the active queue and update their data
             if searchID in recentQueue:
-                objectIndex = recentQueue.index(searchID)
-                returningObject = recentQueue.pop(objectIndex)
-
+                returningObject = recentQueue.pop(searchID)
                 returningObject.add_data(roadObject)
-
-                if activeRoadObjects[searchID] != None:
-                    raise ValueError
                 activeRoadObjects[searchID] = returningObject
             # Otherwise, create a new instance
             else:
                 # TODO: update
-                newObject = roadObject if type(roadObject) == CameraObject else CameraObject(searchID, roadObject["timestamp"], roadObject["type"], roadObject["lane"], roadObject["speed"], roadObject["idle"])
+                newObject = roadObject if isinstance(roadObject, cameraObjectTypes) else CameraObject(searchID, roadObject["timestamp"], roadObject["type"], roadObject["lane"], roadObject["speed"], roadObject["idle"])
                 activeRoadObjects[searchID] = newObject
-            
+            # Objects that just became active need an expiry entry, ones that were already active are rescheduled lazily
+            expiry.schedule(searchID, activeRoadObjects[searchID].lastSeen + expiry.idleTimeout)
 
-    # Grab all of the objects that were not modified this update, move them to the past queue
-    objectsToPush = []
-    for roadObject in activeRoadObjects:
-        if activeRoadObjects[roadObject].modified == 0:
-            objectsToPush.append(roadObject)
-        else: activeRoadObjects[roadObject].modified = 0
+        lastSeen = activeRoadObjects[searchID].lastSeen
+        if frameTime == None or lastSeen > frameTime:
+            frameTime = lastSeen
 
-    for roadObject in objectsToPush:
-        # If the past queue is full, move the oldest ones onto the database
-        tempObject = activeRoadObjects.pop(roadObject)
-        recentQueue.append(tempObject)
+    if frameTime == None: return
+    expire_objects(location, data_push_function, activeRoadObjects, recentQueue, currentBin, heatmapRollup, expiry, frameTime)
 
+'''
+    Same as pushObjectData, for a FrameBatch from the parsers. The columns are converted to plain values once for the whole frame,
+    and each detection is merged into its tracked object directly, without building a camera object for it.
+    The merge is per row on purpose: every tracked object is its own Python object with its own path buffer, so matching
+    ids with numpy would still leave one update call per row, and frames only hold a few dozen objects.
+    Zones should already be set on the batch with classify_zones
+'''
+def pushFrameBatch(batch, location, data_push_function, activeRoadObjects, recentQueue: OrderedDict, currentBin, heatmapRollup, expiry: ObjectExpiry = None):
+    if expiry == None:
+        expiry = get_default_expiry(activeRoadObjects)
+    frameTime = batch.timestamp
+    zoneVersion = batch.zoneVersion
+    speeds = batch.speeds.tolist()
+    lats = batch.lats.tolist()
+    lons = batch.lons.tolist()
+    hasCenter = ~np.isnan(batch.centersOfGravity).any(axis=1)
+    centers = batch.centersOfGravity.tolist()
+    hasBoundingBox = ~np.isnan(batch.boundingBoxes).any(axis=1)
+    boundingBoxes = batch.boundingBoxes.tolist()
+    rows = zip(batch.ids.tolist(), batch.types.tolist(), batch.certainties.tolist(), speeds, batch.zones, lats, lons, hasCenter.tolist(), centers, hasBoundingBox.tolist(), boundingBoxes)
+    for searchID, detectedType, certainty, speed, zone, lat, lon, centerFound, center, boundingBoxFound, boundingBox in rows:
+        # NaN marks a missing value
+        speed = None if speed != speed else speed
+        objectCenter = None if lat != lat or lon != lon else (lat, lon)
+        center = center if centerFound else None
+
+        trackedObject = activeRoadObjects.get(searchID)
+        if trackedObject != None:
+            trackedObject.add_detection(frameTime, detectedType, certainty, speed, zone, objectCenter, center, zoneVersion)
+            continue
+        # Revive the object from the recent queue, otherwise create a new one
+        trackedObject = recentQueue.pop(searchID, None)
+        if trackedObject != None:
+            trackedObject.add_detection(frameTime, detectedType, certainty, speed, zone, objectCenter, center, zoneVersion)
+        else:
+            trackedObject = CompactCameraObject(searchID, frameTime, detectedType=detectedType, detectionCertainty=certainty, speed=speed, objectCenter=objectCenter)
+            if center != None:
+                trackedObject.centerOfGravity = tuple(center)
+                trackedObject.pathBuffer.extend(center)
+            if boundingBoxFound:
+                trackedObject.boundingBox = tuple(boundingBox)
+            trackedObject.add_lane(zone, zoneVersion)
+        activeRoadObjects[searchID] = trackedObject
+        expiry.schedule(searchID, trackedObject.lastSeen + expiry.idleTimeout)
 
+    expire_objects(location, data_push_function, activeRoadObjects, recentQueue, currentBin, heatmapRollup, expiry, frameTime)
+
+def expire_objects(location, data_push_function, activeRoadObjects, recentQueue: OrderedDict, currentBin, heatmapRollup, expiry: ObjectExpiry, frameTime: datetime):
+    # Move the objects that have gone idle to the past queue, and push the ones that have been gone long enough to the database
+    for objectId, stage in expiry.pop_due(frameTime):
+        if stage == "active":
+            trackedObject = activeRoadObjects.get(objectId)
+            if trackedObject == None: continue
+            deadline = trackedObject.lastSeen + expiry.idleTimeout
+            if deadline > frameTime:
+                expiry.schedule(objectId, deadline)
+                continue
+            recentQueue[objectId] = activeRoadObjects.pop(objectId)
+            expiry.schedule(objectId, trackedObject.lastSeen + expiry.finishTimeout, "recent")
+        else:
+            trackedObject = recentQueue.get(objectId)
+            # Revived objects, or ones that already went to the database, have a newer entry or none at all
+            if trackedObject == None or trackedObject.lastSeen + expiry.finishTimeout > frameTime: continue
+            recentQueue.pop(objectId)
+            push_object(trackedObject, location, data_push_function, currentBin, heatmapRollup)
+
+    # If the past queue is full, move the oldest ones onto the database
     while len(recentQueue) > recentQueueThreshold:
-        objectToAddToDB = recentQueue.pop(0)
-        roadObjectData = objectToAddToDB.get_data()
-        roadObjectData["location"] = location
-        data_push_function(roadObjectData, total_heatmaps, currentBin)
\ No newline at end of file
+        _, objectToAddToDB = recentQueue.popitem(last=False)
+        push_object(objectToAddToDB, location, data_push_function, currentBin, heatmapRollup)
+
+def push_object(roadObject, location, data_push_function, currentBin, heatmapRollup):
+    roadObjectData = roadObject.get_data()
+    roadObjectData["location"] = location
+    data_push_function(roadObjectData, heatmapRollup, currentBin)
\ No newline at end of file
@@ -0,0 +1,204 @@
+'''
+    Compact storage schema for the 5 minute count bins.
+    Instead of a document that repeats location, interval and a {"zone": ...} dict per zone in both counts and speeds,
+    every camera gets append-only index tables of its zone and type names (the countTables collection), and a bin
+    is four parallel arrays over the (zone, type) pairs that were seen:
+
+        {"timestamp": ..., "location": "camera", "z": [zone index, ...], "t": [type index, ...],
+         "n": [count, ...], "s": [average speed, ...], "v": [zone version, ...]}
+
+    Bins go to the countSeries time-series collection (timeField timestamp, metaField location), which buckets
+    each camera's bins together on disk, with an index on (location, timestamp).
+    Turned on with compactCounts = true in connection.ini. To convert the existing counts collection:
+
+        python countschema.py migrate [--batch-size 1000] [--drop-old]
+'''
+import argparse
+
+import pymongo
+from pymongo import ReturnDocument
+
+countSeriesName = "countSeries"
+countTablesName = "countTables"
+
+'''
+    Zone and type index tables for every camera. Names are only ever appended, so an index never changes meaning.
+    The stored tables decide the indexes: a new name is added with $addToSet and its index read back from the stored
+    array, so two processes adding names to one camera (a reader and a migration) agree on them
+'''
+class CountTables():
+    def __init__(self, collection):
+        self.collection = collection
+        self.tables = {}
+
+    def get_tables(self, location):
+        if location not in self.tables:
+            stored = self.collection.find_one({"location": location}) or {}
+            self.tables[location] = {"zones": list(stored.get("zones", [])), "types": list(stored.get("types", []))}
+        return self.tables[location]
+
+    def get_index(self, location, table, name):
+        names = self.get_tables(location)[table]
+        if name not in names:
+            stored = self.collection.find_one_and_update(
+                {"location": location}, {"$addToSet": {table: name}}, upsert=True, return_document=ReturnDocument.AFTER)
+            self.tables[location] = {"zones": list(stored.get("zones", [])), "types": list(stored.get("types", []))}
+            names = self.tables[location][table]
+        return names.index(name)
+
+'''
+    A count bin from add_countBin in the compact layout. A bin read from the counts collection keeps its _id as sourceId
+'''
+def compact_bin(countBin, countTables: CountTables):
+    location = countBin["location"]
+    compact = {"timestamp": countBin["timestamp"], "location": location, "z": [], "t": [], "n": [], "s": [], "v": countBin.get("zoneVersions", [])}
+    if "_id" in countBin:
+        compact["sourceId"] = countBin["_id"]
+    for countsObject, speedsObject in zip(countBin["counts"], countBin["speeds"]):
+        zoneIndex = countTables.get_index(location, "zones", countsObject["zone"])
+        for detectedType, count in countsObject.items():
+            if detectedType == "zone": continue
+            compact["z"].append(zoneIndex)
+            compact["t"].append(countTables.get_index(location, "types", detectedType))
+            compact["n"].append(count)
+            compact["s"].append(speedsObject.get(detectedType))
+    return compact
+
+'''
+    Back to the add_countBin layout, for readers of the old schema
+'''
+def expand_bin(compact, countTables: CountTables, interval = 300):
+    tables = countTables.get_tables(compact["location"])
+    counts = {}
+    speeds = {}
+    for zoneIndex, typeIndex, count, speed in zip(compact["z"], compact["t"], compact["n"], compact["s"]):
+        zone = tables["zones"][zoneIndex]
+        detectedType = tables["types"][typeIndex]
+        counts.setdefault(zone, {})[detectedType] = count
+        speeds.setdefault(zone, {})[detectedType] = speed
+    return {
+        "timestamp": compact["timestamp"],
+        "location": compact["location"],
+        "interval": interval,
+        "counts": [dict(counts[zone], zone=zone) for zone in counts],
+        "speeds": [dict(speeds[zone], zone=zone) for zone in speeds],
+        "zoneVersions": compact.get("v", []),
+    }
+
+'''
+    Create the time-series collection and the indexes the compact schema needs, if they are missing
+'''
+def create_count_collections(database):
+    if countSeriesName not in database.list_collection_names():
+        try:
+            database.create_collection(countSeriesName, timeseries={"timeField": "timestamp", "metaField": "location", "granularity": "minutes"})
+        except pymongo.errors.CollectionInvalid:
+            # Another reader created it first
+            pass
+    database[countSeriesName].create_index([("location", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)])
+    database[countTablesName].create_index("location", unique=True)
+
+'''
+    Stands in for the counts collection behind the count writer: takes bins in the add_countBin layout and stores them compact
+'''
+class CompactCountCollection():
+    name = countSeriesName
+    # Time-series collections do not enforce a unique _id, so a resent bin is stored twice. See BufferedWriter.write
+    rejectsDuplicates = False
+
+    def __init__(self, getDatabase):
+        self.getDatabase = getDatabase
+        self.countTables = None
+
+    def get_collection(self):
+        database = self.getDatabase()
+        if self.countTables == None:
+            create_count_collections(database)
+            self.countTables = CountTables(database[countTablesName])
+        return database[countSeriesName]
+
+    def insert_many(self, documents, ordered = True):
+        collection = self.get_collection()
+        collection.insert_many([compact_bin(document, self.countTables) for document in documents], ordered=ordered)
+
+    def insert_one(self, document):
+        self.insert_many([document])
+
+'''
+    The _ids of the counts bins in a batch that countSeries already has a copy of.
+    Keyed on _id, not (location, timestamp): counts can hold more than one bin for a camera and time
+'''
+def find_existing(seriesCollection, batch):
+    return {
+        document["sourceId"]
+        for document in seriesCollection.find({"sourceId": {"$in": [countBin["_id"] for countBin in batch]}}, {"sourceId": 1})
+    }
+
+'''
+    The number of bins in the counts collection that countSeries does not have, checked a batch at a time
+'''
+def count_missing(oldCollection, seriesCollection, batchSize = 1000):
+    missing = 0
+    batch = []
+    for countBin in oldCollection.find({}, {"_id": 1}).batch_size(batchSize):
+        batch.append(countBin)
+        if len(batch) >= batchSize:
+            missing += len(batch) - len(find_existing(seriesCollection, batch))
+            batch = []
+    if len(batch) > 0:
+        missing += len(batch) - len(find_existing(seriesCollection, batch))
+    return missing
+
+'''
+    Copy every bin of the counts collection into countSeries, in timestamp order and in batches.
+    Bins that are already in countSeries (a copy with their _id as sourceId) are skipped, so an interrupted migration can be rerun.
+    The old collection is only dropped once every one of its bins is found in countSeries
+'''
+def migrate(database, batchSize = 1000, dropOld = False):
+    countCollection = CompactCountCollection(lambda: database)
+    seriesCollection = countCollection.get_collection()
+    seriesCollection.create_index("sourceId")
+    oldCollection = database["counts"]
+    migrated = 0
+    skipped = 0
+    batch = []
+
+    def write_batch():
+        nonlocal migrated, skipped
+        if len(batch) == 0: return
+        existing = find_existing(seriesCollection, batch)
+        newBins = [countBin for countBin in batch if countBin["_id"] not in existing]
+        skipped += len(batch) - len(newBins)
+        if len(newBins) > 0:
+            countCollection.insert_many(newBins)
+        migrated += len(newBins)
+        batch.clear()
+        print(f"Migrated {migrated} bins, skipped {skipped}")
+
+    for countBin in oldCollection.find().sort([("location", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)]).batch_size(batchSize):
+        batch.append(countBin)
+        if len(batch) >= batchSize:
+            write_batch()
+    write_batch()
+
+    if dropOld:
+        # Not a count comparison: with compactCounts on, live bins are going into countSeries during the migration
+        missing = count_missing(oldCollection, seriesCollection, batchSize)
+        if missing == 0:
+            oldCollection.drop()
+            print("Dropped the old counts collection")
+        else:
+            print(f"Not dropping the old counts collection, {missing} of its bins are not in countSeries")
+    return migrated, skipped
+
+if __name__ == "__main__":
+    import mongointerface
+
+    argumentParser = argparse.ArgumentParser(description="Compact count bin storage")
+    subcommands = argumentParser.add_subparsers(dest="command", required=True)
+    migrateParser = subcommands.add_parser("migrate", help="Copy the counts collection into the compact countSeries collection")
+    migrateParser.add_argument("--batch-size", type=int, default=1000)
+    migrateParser.add_argument("--drop-old", action="store_true", help="Drop the counts collection once every bin is copied")
+    arguments = argumentParser.parse_args()
+    if arguments.command == "migrate":
+        migrate(mongointerface.get_database(), arguments.batch_size, arguments.drop_old)
@@ -1,146 +1,75 @@
-import xml.etree.ElementTree as ET
-import re
-from typing import Dict
-from collections import defaultdict
 import sys
+import socket
 import subprocess
+from datetime import timedelta
 
-from camera_object import CameraObject
-from pointSearch import whichLane, setLanePairsFromDBList
-from collectData import pushObjectData
-from mongointerface import add_count_mongo, get_camera_data
+from pointSearch import setLanePairsFromDBList
+from collectData import ObjectExpiry
+from mongointerface import add_count_mongo
+from cameracache import CameraCache
 from broadcastlatlon import connect_to_server, send_websocket_data
+from sinkstage import SinkStage
+from metadataframer import MetadataFramer
+from metadatahandler import MetadataHandler
+from fieldprojection import countsProjection
 
-# TODO: Get camera data from mongodb
-camera_info = get_camera_data(sys.argv[1])
+# Camera config comes from a local snapshot of the cameras collection, refreshed in the background. See cameracache.py
+cameraCache = CameraCache()
+camera_info = cameraCache.get_camera(sys.argv[1])
+if camera_info == None:
+    sys.exit(f"Camera {sys.argv[1]} is not in the cameras collection")
 connect_to_server(8001)
 
+# Database writes run behind a bounded queue so that a slow database does not back up the ffmpeg pipe. See sinkstage.py
+sinkQueueSize = 2000
+sinkPolicy = "spill"
 
-# The speeds coming off of the camera are in meters per second. Currently multiplying by this factor to convert to mph
-speedFactor = 2.237
+# Objects move to the recent queue after this long without an update, and are sent to the database after this long
+objectIdleTimeout = timedelta(seconds=1)
+objectFinishTimeout = timedelta(seconds=5)
 
-# CAMERA SPECIFIC DATA TRACKING OBJECTS - The reason why these are here is that they were originally global variables. This makes the program thread-safe
-# For use in collection to send to the db. For more info see collectData.py
-activeRoadObjects: Dict[str, CameraObject] = {}
-recentQueue: list[CameraObject] = []
-# For use in the mongodb interface
-currentBin = {
-    "counts": defaultdict(lambda: defaultdict(int)),
-    "speeds": defaultdict(lambda: defaultdict(float)),
-    "timestamp": 0,
-    "heatmap": {}
-}
-lanes = setLanePairsFromDBList(camera_info["zones"])
-total_heatmaps = []
-timestamp = None
-openObject = False
-frameObjects = []
-currentObject: CameraObject | None = None
-coordinateSet = []
-
-def parse_element(event, elem):
-    global timestamp, openObject, currentObject, frameObjects, camera_info, coordinateSet, lanes
-    if elem.tag == "root": return
-    # Look for the opening of the frame to collect objects
-
-    tag = elem.tag.split("}")[1]
+# Collect each frame as one columnar FrameBatch instead of a camera object per detection. See framebatch.py
+emitFrameBatches = True
 
-    if tag == "Frame":
-        if event == "start":
-            timestamp = elem.attrib['UtcTime']
-        elif event == "end":
-            # TODO: Send the objects and live coordinates
-            if frameObjects != []:   
-                try:
-                    # send_websocket_data(coordinateSet, camera_info["name"])
-                    coordinateSet = []
-                except Exception as error:
-                    print("Coordinate Livestream Error", error)
-                pushObjectData(
-                    frameObjects, 
-                    camera_info["name"], 
-                    data_push_function = add_count_mongo, 
-                    activeRoadObjects=activeRoadObjects, 
-                    recentQueue=recentQueue,
-                    currentBin= currentBin,
-                    total_heatmaps=total_heatmaps)
-                frameObjects = []
+# The metadata fields to extract from each object, see fieldprojection.py. Deployments that store object shapes can use fullProjection
+extractedFields = countsProjection
 
-            
-    elif tag == "Object":
-        # starting a new object
-        if event == "start":
-            openObject = True
-            currentObject = CameraObject(elem.attrib["ObjectId"], timestamp)
-            # create the new class
-        # closing the object and pushing it off
-        elif event == "end":
-            openObject = False
-            elem.clear()
-            # push current object
-            coordinateSet.append({
-                "xy": currentObject.getCurrentLocation(),
-                "zone": currentObject.getCurrentZone(),
-                "type": currentObject.getDetectedType()
-            })
-            frameObjects.append(currentObject)
-            currentObject = None
-    elif openObject == True:
-        if tag == "GeoLocation":
-            lat = float(elem.attrib["lat"]) + float(camera_info["coordinates"][0])
-            lon = float(elem.attrib["lon"]) + float(camera_info["coordinates"][1])
-            currentObject.setLatLon(lat, lon)
-            # TODO: Set zone area
-            lane = whichLane((lat, lon), lanes)
-            currentObject.add_lane(lane)
-        elif tag == "Point":
-            pass
-        elif tag == "Type":
-            if 'Likelihood' in elem.attrib and elem.text != None:
-                currentObject.setDetectedType(elem.text) 
-                currentObject.setDetectionCertainty(float(elem.attrib['Likelihood']))
-        elif tag == "Speed":
-            currentObject.setSpeed(float(elem.text) * speedFactor)
-        else:
-            pass
-    
+# CAMERA SPECIFIC DATA TRACKING OBJECTS live in the handler, see metadatahandler.py
+lanes = setLanePairsFromDBList(camera_info["zones"])
+databaseSink = SinkStage(add_count_mongo, maxSize=sinkQueueSize, policy=sinkPolicy, spillPath=f"{camera_info['name']}.spill")
+handler = MetadataHandler(
+    camera_info,
+    lanes,
+    dataPushFunction = databaseSink.push,
+    emitFrameBatches = emitFrameBatches,
+    objectExpiry = ObjectExpiry(objectIdleTimeout, objectFinishTimeout),
+    # Live coordinates go to the broadcast hub from a background thread, see broadcastlatlon.py
+    sendCoordinates = send_websocket_data,
+    fields = extractedFields)
+# Zone edits in the database are picked up on the next refresh. The new index is built on the cache's thread and swapped in between frames
+cameraCache.watch_zones(camera_info["name"], lambda zones: handler.set_lanes(setLanePairsFromDBList(zones)))
 
-command = f'ffmpeg -i "../oldstuff/output1.xml" -map 0:d -c copy -copy_unknown -loglevel fatal -f data -'
-with subprocess.Popen(
-    command, stdout=subprocess.PIPE, shell=True
-) as process:
-    parser = ET.XMLPullParser(['start', 'end'])
-    # Add a root element to prevent the parser from complaining about bad xml
-    parser.feed('<root>')
+'''
+    Where the metadata comes from: ffmpeg on the recorded file by default. For load testing (see metadatagenerator.py)
+    the second argument can be "-" for stdin, tcp://host:port to connect to a generator, or the path of a raw metadata file
+'''
+def open_source(source = None):
+    if source == None:
+        command = f'ffmpeg -i "../oldstuff/output1.xml" -map 0:d -c copy -copy_unknown -loglevel fatal -f data -'
+        return subprocess.Popen(command, stdout=subprocess.PIPE, shell=True).stdout
+    if source == "-":
+        return sys.stdin.buffer
+    if source.startswith("tcp://"):
+        host, port = source[len("tcp://"):].rsplit(":", 1)
+        return socket.create_connection((host, int(port))).makefile("rb")
+    return open(source, "rb")
 
-    foundStart = False
-    i = 0
+with open_source(sys.argv[2] if len(sys.argv) > 2 else None) as stream:
+    # Cuts the pipe into complete MetadataStream packets, see metadataframer.py
+    framer = MetadataFramer()
     while True:
-        i += 1
-        value = process.stdout.read1()
-        # Reset to a new block
-        if not foundStart:
-            # Search for the beginning of the packet
-            res = re.search("<tt:MetadataStream", value.decode('utf-8'))
-            if res != None:
-                value = value[res.start():]
-                foundStart = True
-
-        # If the beginning of the packet has been found and everything is working properly:
-        if foundStart:
-            # Start parsing the data
-            parser.feed(value)
-            # Refrain for a little bit to grab a full packet
-            if i > 5:
-                # Put into a try-except block as any bad xml(from lost data) raises an exception
-                try:
-                    for event, elem in parser.read_events():
-                        parse_element(event, elem)
-                        elem.clear()
-                # If there is bad data, we drop the packet and reset the parser
-                except:
-                    i = 0
-                    foundStart = False
-                    parser = ET.XMLPullParser(['start', 'end'])
-                    parser.feed('<root>')
-        
+        value = stream.read1()
+        if not value: break
+        # If there is bad data, only that packet is dropped. The framer is already at the start of the next one
+        for packet in framer.feed(value):
+            handler.feed_packet(packet)
@@ -0,0 +1,35 @@
+'''
+    Field projection for metadata extraction: which ONVIF fields the parsers pull out of each object.
+    Every field names the element it is read from, matched by local name anywhere inside the <Object>.
+    How an element is read is up to each parser, so this only decides which elements get looked up:
+    the streaming handler (metadatahandler.py) and parseXml (xmlmetadata.py) are both built from a projection,
+    a tuple of field names, so fields that are left out are never looked up or converted.
+'''
+metadataFields = {
+    "location": "GeoLocation",
+    "type": "Type",
+    "speed": "Speed",
+    "boundingBox": "BoundingBox",
+    "centerOfGravity": "CenterOfGravity",
+}
+
+# Everything the parsers know how to read
+fullProjection = tuple(metadataFields)
+# Enough for counts and speeds per zone and type: no shapes. What the streaming readers extract by default
+countsProjection = ("location", "type", "speed")
+
+'''
+    Check a projection and return it as a set of field names
+'''
+def compile_projection(fields = fullProjection):
+    unknownFields = [field for field in fields if field not in metadataFields]
+    if len(unknownFields) > 0:
+        raise ValueError(f"Unknown metadata fields {unknownFields}, expected some of {fullProjection}")
+    return frozenset(fields)
+
+'''
+    Build a dispatch table {element tag: handler} for the fields in a projection.
+    handlers maps each field name to the function that reads it, qualify turns an element name into the parser's tag
+'''
+def compile_dispatch(fields, handlers, qualify = lambda tag: tag):
+    return {qualify(metadataFields[field]): handlers[field] for field in compile_projection(fields)}
@@ -0,0 +1,120 @@
+import numpy as np
+
+from pointSearch import whichLanes
+
+'''
+    Columnar (struct-of-arrays) view of every object detected in one frame.
+    Instead of a CameraObject per detection, each field is one NumPy array with a row per object, and the whole
+    frame shares a single parsed timestamp. Missing values are NaN: speeds, lat/lon, bounding boxes and centers of gravity.
+'''
+class FrameBatch():
+    def __init__(self, timestamp, ids, types, certainties, speeds, lats, lons, boundingBoxes, centersOfGravity):
+        self.timestamp = timestamp
+        self.ids = np.array(ids, dtype=object)
+        self.types = np.array(types, dtype=object)
+        self.certainties = np.array(certainties, dtype=float)
+        self.speeds = np.array(speeds, dtype=float)
+        self.lats = np.array(lats, dtype=float)
+        self.lons = np.array(lons, dtype=float)
+        # Bottom, top, right, left - the same order as CameraObject.boundingBox
+        self.boundingBoxes = np.array(boundingBoxes, dtype=float).reshape(-1, 4)
+        self.centersOfGravity = np.array(centersOfGravity, dtype=float).reshape(-1, 2)
+        # Filled in by classify_zones, with the version of the zone set they came from
+        self.zones = ["Unknown"] * len(self.ids)
+        self.zoneVersion = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def locations(self):
+        return np.column_stack((self.lats, self.lons))
+
+    def classify_zones(self, lanes, zoneLookup = whichLanes):
+        self.zones = zoneLookup(self.locations(), lanes)
+        self.zoneVersion = getattr(lanes, "version", None)
+        return self.zones
+
+    '''
+        Offsets every location by the camera's coordinates and scales every speed at once
+    '''
+    def offset_locations(self, offset):
+        self.lats += float(offset[0])
+        self.lons += float(offset[1])
+
+    def scale_speeds(self, factor):
+        self.speeds *= factor
+
+    '''
+        Live coordinate entries in the same shape the parsers send over the websocket
+    '''
+    def get_coordinate_set(self):
+        coordinateSet = []
+        for lat, lon, zone, detectedType in zip(self.lats.tolist(), self.lons.tolist(), self.zones, self.types.tolist()):
+            coordinateSet.append({
+                "xy": None if lat != lat else (lat, lon),
+                "zone": zone,
+                "type": detectedType
+            })
+        return coordinateSet
+
+'''
+    Collects the fields of a frame's objects as the parser walks them, then builds a FrameBatch when the frame ends.
+    The setters mirror CameraObject's, so the parsers can fill the current row the same way they fill a CameraObject
+'''
+class FrameBatchBuilder():
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.ids = []
+        self.types = []
+        self.certainties = []
+        self.speeds = []
+        self.lats = []
+        self.lons = []
+        self.boundingBoxes = []
+        self.centersOfGravity = []
+
+    def add_object(self, objectId):
+        self.ids.append(objectId)
+        self.types.append("None")
+        self.certainties.append(0.0)
+        self.speeds.append(np.nan)
+        self.lats.append(np.nan)
+        self.lons.append(np.nan)
+        self.boundingBoxes.append((np.nan, np.nan, np.nan, np.nan))
+        self.centersOfGravity.append((np.nan, np.nan))
+
+    '''
+        Remove the last row, for objects that turn out to be malformed halfway through
+    '''
+    def discard_object(self):
+        for column in (self.ids, self.types, self.certainties, self.speeds, self.lats, self.lons, self.boundingBoxes, self.centersOfGravity):
+            column.pop()
+
+    def setLatLon(self, lat, lon):
+        self.lats[-1] = lat
+        self.lons[-1] = lon
+
+    def setDetectedType(self, detectionType):
+        self.types[-1] = detectionType
+
+    def setDetectionCertainty(self, certainty):
+        self.certainties[-1] = certainty
+
+    def setSpeed(self, speedMph):
+        self.speeds[-1] = np.nan if speedMph == None else speedMph
+
+    def set_bounding_box_xml(self, boundingBoxObject):
+        self.boundingBoxes[-1] = (float(boundingBoxObject.get("bottom")), float(boundingBoxObject.get("top")), float(boundingBoxObject.get("right")), float(boundingBoxObject.get("left")))
+
+    def set_centerofgravity_xml(self, centerOfGravityObject):
+        self.centersOfGravity[-1] = (float(centerOfGravityObject.get("x")), float(centerOfGravityObject.get("y")))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def build(self, timestamp):
+        batch = FrameBatch(timestamp, self.ids, self.types, self.certainties, self.speeds, self.lats, self.lons, self.boundingBoxes, self.centersOfGravity)
+        self.reset()
+        return batch
@@ -1,12 +1,279 @@
 from collections import defaultdict
+from datetime import datetime, timedelta
+import numpy as np
 
 # Objective: within each five minute bin, push a heatmap containing latitude/longitude position frequencies summed up across the bin
 
+# Points are summed up once this many are waiting
+pendingPointLimit = 65536
+
+# Heatmap rollup windows in seconds. Every closed count bin is added to all of them
+heatmapWindows = {"hour": 3600, "day": 86400}
+
+# Zoom levels of the heatmap tile pyramid (slippy map tiles), and the number of cells along each side of a tile
+heatmapTileZooms = (10, 12, 14, 16, 18)
+tileResolution = 64
+# Web mercator stops here
+maxLatitude = 85.05112878
+
+'''
+    Heatmap backed by integer grid cells instead of nested string-keyed dicts.
+    Points are quantized to cells of 10^-granularity degrees (the same boxes as add_to_heatmap) and stored relative to
+    a quantized origin, the first cell seen, as one int64 key per cell: the latitude offset in the high 32 bits and the
+    longitude offset in the low 32 bits. Vehicle paths are collected as they come and quantized together in batches,
+    and the pending keys are combined with a np.unique sum-reduce, so the accumulator is a sorted sparse array of (key, weight).
+    extract produces the same {"coordinate": "lat_lon", "weight": n} list as extract_heatmap.
+'''
+class HeatmapAccumulator():
+    def __init__(self, granularity = 6):
+        self.granularity = granularity
+        self.scale = 10 ** granularity
+        self.origin = None
+        self.keys = np.empty(0, dtype=np.int64)
+        self.weights = np.empty(0, dtype=np.int64)
+        self.pendingKeys = []
+        self.pendingWeights = []
+        self.pendingCount = 0
+        # Path points not quantized yet
+        self.pendingPoints = []
+
+    '''
+        Add an (n, 2) array of (lat, lon) points, each with a weight of one (or the matching entry of weights).
+        Points with missing coordinates are skipped
+    '''
+    def add_points(self, points, weights = None):
+        points = np.asarray(points, dtype=float).reshape(-1, 2)
+        finite = np.isfinite(points).all(axis=1)
+        if not finite.all():
+            points = points[finite]
+            weights = None if weights is None else np.asarray(weights)[finite]
+        if len(points) == 0: return
+        cells = self.quantize(points)
+        if self.origin is None:
+            self.origin = cells[0].copy()
+        self.add_keys(self.get_keys(cells), np.ones(len(cells), dtype=np.int64) if weights is None else np.asarray(weights, dtype=np.int64))
+
+    '''
+        Cells of the same boxes that round(value, granularity) picks. Scaling can land a value that is just off of a half
+        on the half (or the other way around), and np.rint breaks ties to even, so values that scale to within a hair of
+        a half are quantized with round itself
+    '''
+    def quantize(self, points):
+        scaled = points * self.scale
+        cells = np.rint(scaled)
+        nearHalf = np.abs(np.abs(scaled - np.trunc(scaled)) - 0.5) < 1e-6
+        if nearHalf.any():
+            cells[nearHalf] = np.rint(np.array([round(value, self.granularity) for value in points[nearHalf].tolist()]) * self.scale)
+        return cells.astype(np.int64)
+
+    # Most paths are short, so they are only collected here and go through numpy together
+    def add(self, roadObjectData):
+        self.pendingPoints.extend(roadObjectData["mapPath"])
+        if len(self.pendingPoints) >= pendingPointLimit:
+            self.add_pending_points()
+
+    def add_pending_points(self):
+        points = self.pendingPoints
+        self.pendingPoints = []
+        self.add_points(points)
+
+    def get_keys(self, cells):
+        offsets = cells - self.origin
+        return (offsets[:, 0] << 32) + offsets[:, 1]
+
+    def get_cells(self, keys):
+        # Undo get_keys, the longitude offset is signed so it borrows from the latitude half when negative
+        lonOffsets = ((keys + (1 << 31)) & 0xFFFFFFFF) - (1 << 31)
+        latOffsets = (keys - lonOffsets) >> 32
+        return np.stack((latOffsets, lonOffsets), axis=1) + self.origin
+
+    def add_keys(self, keys, weights):
+        self.pendingKeys.append(keys)
+        self.pendingWeights.append(weights)
+        self.pendingCount += len(keys)
+        if self.pendingCount >= pendingPointLimit:
+            self.compact()
+
+    '''
+        Sum the pending points into the (key, weight) arrays
+    '''
+    def compact(self):
+        if len(self.pendingPoints) > 0:
+            self.add_pending_points()
+        if self.pendingCount == 0: return
+        keys = np.concatenate([self.keys] + self.pendingKeys)
+        weights = np.concatenate([self.weights] + self.pendingWeights)
+        self.keys, inverse = np.unique(keys, return_inverse=True)
+        self.weights = np.bincount(inverse, weights=weights, minlength=len(self.keys)).astype(np.int64)
+        self.pendingKeys = []
+        self.pendingWeights = []
+        self.pendingCount = 0
+        # Path points not quantized yet
+        self.pendingPoints = []
+
+    '''
+        Add another accumulator's weights to this one. Both must use the same granularity
+    '''
+    def merge(self, other):
+        other.compact()
+        if len(other.keys) == 0: return
+        if self.origin is None:
+            self.origin = other.origin.copy()
+        self.add_keys(self.get_keys(other.get_cells(other.keys)), other.weights)
+
+    # (n, 2) array of (lat, lon) cell centers and the matching weights
+    def get_points(self):
+        self.compact()
+        if len(self.keys) == 0:
+            return np.empty((0, 2)), self.weights
+        return self.get_cells(self.keys) / self.scale, self.weights
+
+    '''
+        The heatmap as a tile pyramid: for every zoom, the slippy map tiles (x, y) that hold any weight, each binned into
+        a tileResolution x tileResolution grid. Returns a list of
+        {"zoom", "x", "y", "quadkey", "weight", "cells": [[column, row, weight], ...]}, with rows counted from the tile's top
+    '''
+    def build_tiles(self, zooms = heatmapTileZooms, resolution = tileResolution):
+        points, weights = self.get_points()
+        tiles = []
+        if len(points) == 0: return tiles
+        for zoom in zooms:
+            side = (2 ** zoom) * resolution
+            x, y = project_to_tiles(points, zoom)
+            pixelX = np.clip(np.floor(x * resolution).astype(np.int64), 0, side - 1)
+            pixelY = np.clip(np.floor(y * resolution).astype(np.int64), 0, side - 1)
+            # Sum up the weight of every grid cell, then group the cells by tile
+            pixels, inverse = np.unique(pixelX * side + pixelY, return_inverse=True)
+            pixelWeights = np.bincount(inverse, weights=weights, minlength=len(pixels)).astype(np.int64)
+            pixelX, pixelY = pixels // side, pixels % side
+            tileKeys = (pixelX // resolution) * (2 ** zoom) + pixelY // resolution
+            order = np.argsort(tileKeys, kind="stable")
+            tileKeys, pixelX, pixelY, pixelWeights = tileKeys[order], pixelX[order], pixelY[order], pixelWeights[order]
+            tileStarts = np.flatnonzero(np.r_[True, tileKeys[1:] != tileKeys[:-1]])
+            for start, end in zip(tileStarts.tolist(), np.r_[tileStarts[1:], len(tileKeys)].tolist()):
+                tileX, tileY = int(pixelX[start] // resolution), int(pixelY[start] // resolution)
+                cells = np.stack((pixelX[start:end] - tileX * resolution, pixelY[start:end] - tileY * resolution, pixelWeights[start:end]), axis=1)
+                tiles.append({
+                    "zoom": zoom,
+                    "x": tileX,
+                    "y": tileY,
+                    "quadkey": get_quadkey(tileX, tileY, zoom),
+                    "weight": int(pixelWeights[start:end].sum()),
+                    "cells": cells.tolist(),
+                })
+        return tiles
+
+    def extract(self):
+        self.compact()
+        if len(self.keys) == 0: return []
+        cells = self.get_cells(self.keys)
+        # Cells share rows and columns, so every distinct latitude and longitude is only formatted once.
+        # cell / scale is the same float that round(value, granularity) gives, so the keys match add_to_heatmap's
+        latCells, latIndexes = np.unique(cells[:, 0], return_inverse=True)
+        lonCells, lonIndexes = np.unique(cells[:, 1], return_inverse=True)
+        latKeys = [str(lat) for lat in (latCells / self.scale).tolist()]
+        lonKeys = [str(lon) for lon in (lonCells / self.scale).tolist()]
+        return [
+            {"coordinate": f"{latKeys[latIndex]}_{lonKeys[lonIndex]}", "weight": weight}
+            for latIndex, lonIndex, weight in zip(latIndexes.tolist(), lonIndexes.tolist(), self.weights.tolist())
+        ]
+
+    def __len__(self):
+        self.compact()
+        return len(self.keys)
+
+'''
+    Fractional slippy map tile coordinates (web mercator) of an (n, 2) array of (lat, lon) points at a zoom level
+'''
+def project_to_tiles(points, zoom):
+    tileCount = 2 ** zoom
+    latitudes = np.radians(np.clip(points[:, 0], -maxLatitude, maxLatitude))
+    x = (points[:, 1] + 180.0) / 360.0 * tileCount
+    y = (1.0 - np.log(np.tan(latitudes) + 1.0 / np.cos(latitudes)) / np.pi) / 2.0 * tileCount
+    return x, y
+
+def get_quadkey(x, y, zoom):
+    digits = []
+    for level in range(zoom, 0, -1):
+        mask = 1 << (level - 1)
+        digits.append(str((1 if x & mask else 0) + (2 if y & mask else 0)))
+    return "".join(digits)
+
+'''
+    The tiles covering a viewport at a zoom level, as inclusive (minX, maxX, minY, maxY). Tile rows count down from the north
+'''
+def get_tile_range(south, west, north, east, zoom):
+    x, y = project_to_tiles(np.array([[north, west], [south, east]], dtype=float), zoom)
+    lastTile = 2 ** zoom - 1
+    tiles = np.clip(np.floor(np.concatenate((x, y))).astype(np.int64), 0, lastTile).tolist()
+    return tiles[0], tiles[1], tiles[2], tiles[3]
+
+'''
+    Running heatmap totals for several rollup windows at once (hourly and daily by default).
+    Each closed bin's heatmap is merged into every window as it arrives, instead of keeping the bins until the hour is up,
+    so memory holds one accumulator per window and a window closes in one pass over its cells.
+    Windows are aligned to multiples of their length since the epoch (in UTC), like the 5 minute bins.
+'''
+class HeatmapRollup():
+    def __init__(self, windows = heatmapWindows, granularity = 6):
+        self.windows = windows
+        self.granularity = granularity
+        self.accumulators = {window: HeatmapAccumulator(granularity) for window in windows}
+        self.windowStarts = {window: None for window in windows}
+
+    def get_window_start(self, window, timestamp: datetime):
+        length = self.windows[window]
+        return datetime.fromtimestamp(timestamp.timestamp() - timestamp.timestamp() % length, tz=timestamp.tzinfo)
+
+    '''
+        Add a closed bin's heatmap (an accumulator or a dict from add_to_heatmap) that covers interval seconds from timestamp.
+        Returns (window, window start, accumulator) for every window that is complete, either because this bin was
+        its last one or because this bin already belongs to the next window
+    '''
+    def add_bin(self, timestamp: datetime, heatmap, interval = 300):
+        if not isinstance(heatmap, HeatmapAccumulator):
+            heatmap = accumulator_from_dict(heatmap, self.granularity)
+        closed = []
+        for window, length in self.windows.items():
+            windowStart = self.get_window_start(window, timestamp)
+            if self.windowStarts[window] != None and self.windowStarts[window] != windowStart:
+                closed.append(self.close_window(window))
+            self.windowStarts[window] = windowStart
+            self.accumulators[window].merge(heatmap)
+            if timestamp + timedelta(seconds=interval) >= windowStart + timedelta(seconds=length):
+                closed.append(self.close_window(window))
+        return closed
+
+    def close_window(self, window):
+        closed = (window, self.windowStarts[window], self.accumulators[window])
+        self.accumulators[window] = HeatmapAccumulator(self.granularity)
+        self.windowStarts[window] = None
+        return closed
+
+    '''
+        Close every window that has any bins in it, complete or not. For a camera that stops here
+    '''
+    def close_all(self):
+        return [self.close_window(window) for window in self.windows if self.windowStarts[window] != None]
+
+'''
+    Turn a dict heatmap from add_to_heatmap into an accumulator
+'''
+def accumulator_from_dict(heatmap, granularity = 6):
+    accumulator = HeatmapAccumulator(granularity)
+    points = [(float(latKey), float(lonKey)) for latKey in heatmap for lonKey in heatmap[latKey]]
+    weights = [heatmap[latKey][lonKey] for latKey in heatmap for lonKey in heatmap[latKey]]
+    accumulator.add_points(points, weights)
+    return accumulator
+
 '''
     heatmap should be a 2d hashmap
     granularity is the number of decimal places to make boxes
 '''
 def add_to_heatmap(heatmap, roadObjectData, granularity = 6):
+    if isinstance(heatmap, HeatmapAccumulator):
+        heatmap.add(roadObjectData)
+        return
     # for each coordinate in the map path:
     for coordinateSet in roadObjectData["mapPath"]:
         # get the latitude key
@@ -24,8 +291,19 @@ def add_to_heatmap(heatmap, roadObjectData, granularity = 6):
 
 # Take in the collection of heatmaps and then combine them into a mongo-db friendly format
 def extract_heatmap(heatmap_collection):
+    # Accumulators are summed with each other, without going through strings
+    accumulators = [heatmap for heatmap in heatmap_collection if isinstance(heatmap, HeatmapAccumulator)]
+    if len(accumulators) == len(heatmap_collection) and len(accumulators) > 0:
+        combined = HeatmapAccumulator(accumulators[0].granularity)
+        for accumulator in accumulators:
+            combined.merge(accumulator)
+        return combined.extract()
     output_heatmap = {}
     for heatmap in heatmap_collection:
+        if isinstance(heatmap, HeatmapAccumulator):
+            for entry in heatmap.extract():
+                output_heatmap[entry["coordinate"]] = output_heatmap.get(entry["coordinate"], 0) + entry["weight"]
+            continue
         for latKey in heatmap:
             for lonKey in heatmap[latKey]:
                 output_key = f"{latKey}_{lonKey}"
@@ -0,0 +1,76 @@
+'''
+    Splits the raw bytes coming off of the ffmpeg data pipe into complete <tt:MetadataStream> packets.
+    Everything stays as bytes: packet boundaries are found with bytearray.find over one reusable buffer,
+    and only complete packets are handed back, so the XML parser never sees half of a packet.
+    If a new packet starts before the current one ends (data was lost), the partial packet is dropped and
+    framing resyncs at the new start tag instead of throwing everything away.
+'''
+class MetadataFramer():
+    startTag = b"<tt:MetadataStream"
+    endTag = b"</tt:MetadataStream>"
+
+    def __init__(self, maxPacketSize = 4 * 1024 * 1024):
+        self.buffer = bytearray()
+        # Everything in the buffer before this position has already been searched for both tags
+        self.searchFrom = 0
+        # Anything bigger than this without an end tag is treated as corrupt
+        self.maxPacketSize = maxPacketSize
+        # Stats
+        self.packets = 0
+        self.resyncs = 0
+        self.skippedBytes = 0
+
+    '''
+        Add a chunk of bytes from the pipe, returns the list of packets that were completed by it
+    '''
+    def feed(self, data):
+        self.buffer += data
+        packets = []
+        while True:
+            if not self.find_start():
+                break
+            # The buffer now starts with a start tag
+            scanFrom = max(self.searchFrom, len(self.startTag))
+            end = self.buffer.find(self.endTag, scanFrom)
+            nextStart = self.buffer.find(self.startTag, scanFrom, len(self.buffer) if end == -1 else end)
+            if nextStart != -1:
+                # The current packet was cut off, start over at the next one
+                self.resyncs += 1
+                self.skip(nextStart)
+                continue
+            if end == -1:
+                if len(self.buffer) > self.maxPacketSize:
+                    self.resyncs += 1
+                    self.skip(len(self.buffer))
+                    continue
+                # Wait for more data, but search the tail again in case a tag was split across chunks
+                self.searchFrom = max(len(self.startTag), len(self.buffer) - len(self.endTag) + 1)
+                break
+            packetEnd = end + len(self.endTag)
+            packets.append(bytes(self.buffer[:packetEnd]))
+            del self.buffer[:packetEnd]
+            self.searchFrom = 0
+            self.packets += 1
+        return packets
+
+    '''
+        Drop everything before the next start tag. Returns False if there is no start tag in the buffer yet
+    '''
+    def find_start(self):
+        start = self.buffer.find(self.startTag)
+        if start == -1:
+            # Keep just enough of the tail to match a start tag split across chunks
+            self.skip(max(0, len(self.buffer) - len(self.startTag) + 1))
+            return False
+        self.skip(start)
+        return True
+
+    def skip(self, byteCount):
+        if byteCount == 0: return
+        del self.buffer[:byteCount]
+        self.skippedBytes += byteCount
+        self.searchFrom = 0
+
+    def reset(self):
+        self.buffer.clear()
+        self.searchFrom = 0
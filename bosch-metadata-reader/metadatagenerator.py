@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+"""
+metadatagenerator.py
+Generates synthetic ONVIF metadata streams shaped like the Bosch cameras' output (see test.xml):
+tt:MetadataStream packets holding a tt:Frame with tt:Object entries (bounding box, center of gravity,
+class, GeoLocation and speed), plus an occasional event packet.
+Objects drive in straight lines between random points of the configured zones, so they get zoned and counted.
+
+Used to load test the reader without ffmpeg or a camera, at any multiple of real time:
+
+    python metadatagenerator.py --frames 600 --output stream.xml
+    python metadatagenerator.py --speedup 10 --output tcp://127.0.0.1:9000
+    python ffmpegreader.py <camera name> tcp://127.0.0.1:9000
+
+With more than one camera, file outputs need a {camera} placeholder and tcp ports count up from the given one.
+"""
+
+import sys
+import json
+import time
+import random
+import socket
+import argparse
+import threading
+from datetime import datetime, timedelta, timezone
+
+onvifNamespaces = 'xmlns:tns1="http://www.onvif.org/ver10/topics" xmlns:tt="http://www.onvif.org/ver10/schema" xmlns:wsnt="http://docs.oasis-open.org/wsn/b-2"'
+
+defaultOrigin = (35.0, -120.0)
+# Four approaches to an intersection around the camera, in the same shape as the zones in the cameras collection
+defaultZones = [
+    {"name": "North", "coordinates": [{"lat": 35.0002, "lng": -120.0001}, {"lat": 35.0006, "lng": -120.0001}, {"lat": 35.0006, "lng": -119.9999}, {"lat": 35.0002, "lng": -119.9999}]},
+    {"name": "South", "coordinates": [{"lat": 34.9994, "lng": -120.0001}, {"lat": 34.9998, "lng": -120.0001}, {"lat": 34.9998, "lng": -119.9999}, {"lat": 34.9994, "lng": -119.9999}]},
+    {"name": "East", "coordinates": [{"lat": 34.9999, "lng": -119.9998}, {"lat": 35.0001, "lng": -119.9998}, {"lat": 35.0001, "lng": -119.9992}, {"lat": 34.9999, "lng": -119.9992}]},
+    {"name": "West", "coordinates": [{"lat": 34.9999, "lng": -120.0008}, {"lat": 35.0001, "lng": -120.0008}, {"lat": 35.0001, "lng": -120.0002}, {"lat": 34.9999, "lng": -120.0002}]},
+]
+defaultTypes = {"Car": 0.7, "Truck": 0.1, "Bus": 0.03, "Bike": 0.07, "Human": 0.1}
+
+
+class SimulatedObject():
+    def __init__(self, objectId, detectedType, birthFrame, lifetimeFrames, start, end, speed):
+        self.objectId = objectId
+        self.detectedType = detectedType
+        self.birthFrame = birthFrame
+        self.lifetimeFrames = lifetimeFrames
+        self.start = start
+        self.end = end
+        # Meters per second, like the camera
+        self.speed = speed
+
+    def progress(self, frameIndex):
+        return min(max((frameIndex - self.birthFrame) / self.lifetimeFrames, 0.0), 1.0)
+
+    def location(self, frameIndex):
+        progress = self.progress(frameIndex)
+        return tuple(start + (end - start) * progress for start, end in zip(self.start, self.end))
+
+
+'''
+    One camera's stream: keeps a population of objects, replacing each one when its lifetime runs out
+'''
+class CameraSimulator():
+    def __init__(self, cameraIndex, arguments, zones, origin):
+        self.random = random.Random(arguments.seed + cameraIndex)
+        self.arguments = arguments
+        self.zones = [[(point["lat"], point["lng"]) for point in zone["coordinates"]] for zone in zones]
+        self.origin = origin
+        self.types = list(arguments.types)
+        self.typeWeights = list(arguments.types.values())
+        self.startTime = arguments.start
+        self.nextObjectId = 100000 * (cameraIndex + 1)
+        self.objects = [self.spawn(-self.random.randrange(self.lifetime_frames())) for _ in range(arguments.objects)]
+
+    def lifetime_frames(self):
+        lifetime = self.random.uniform(0.5, 1.5) * self.arguments.lifetime
+        return max(1, round(lifetime * self.arguments.fps))
+
+    '''
+        A random point inside a zone: a random convex combination of its corners
+    '''
+    def point_in_zone(self, zone):
+        weights = [self.random.random() for _ in zone]
+        total = sum(weights)
+        return tuple(sum(point[axis] * weight for point, weight in zip(zone, weights)) / total for axis in (0, 1))
+
+    def spawn(self, birthFrame):
+        startZone, endZone = self.random.sample(self.zones, 2) if len(self.zones) > 1 else (self.zones[0], self.zones[0])
+        simulatedObject = SimulatedObject(
+            self.nextObjectId,
+            self.random.choices(self.types, self.typeWeights)[0],
+            birthFrame,
+            self.lifetime_frames(),
+            self.point_in_zone(startZone),
+            self.point_in_zone(endZone),
+            self.random.uniform(*self.arguments.speed),
+        )
+        self.nextObjectId += 1
+        return simulatedObject
+
+    def object_xml(self, simulatedObject, frameIndex):
+        lat, lon = simulatedObject.location(frameIndex)
+        progress = simulatedObject.progress(frameIndex)
+        # Screen position drifts across the view as the object moves
+        x = round(-0.9 + 1.8 * progress, 4)
+        y = round(0.6 - 1.2 * progress, 4)
+        likelihood = round(self.random.uniform(0.6, 0.99), 2)
+        speed = max(0.0, simulatedObject.speed + self.random.gauss(0, 0.3))
+        return (
+            f'<tt:Object ObjectId="{simulatedObject.objectId}"><tt:Appearance><tt:Shape>'
+            f'<tt:BoundingBox left="{x - 0.05:.4f}" top="{y + 0.05:.4f}" right="{x + 0.05:.4f}" bottom="{y - 0.05:.4f}"/>'
+            f'<tt:CenterOfGravity x="{x}" y="{y}"/>'
+            f'<tt:Polygon><tt:Point x="{x - 0.05:.4f}" y="{y - 0.05:.4f}"/><tt:Point x="{x + 0.05:.4f}" y="{y - 0.05:.4f}"/>'
+            f'<tt:Point x="{x + 0.05:.4f}" y="{y + 0.05:.4f}"/><tt:Point x="{x - 0.05:.4f}" y="{y + 0.05:.4f}"/></tt:Polygon></tt:Shape>'
+            f'<tt:Class><tt:ClassCandidate><tt:Type>{simulatedObject.detectedType}</tt:Type><tt:Likelihood>{likelihood}</tt:Likelihood></tt:ClassCandidate>'
+            f'<tt:Type Likelihood="{likelihood}">{simulatedObject.detectedType}</tt:Type></tt:Class>'
+            f'<tt:GeoLocation lon="{lon - self.origin[1]:.16f}" lat="{lat - self.origin[0]:.16f}" elevation="-10"/></tt:Appearance>'
+            f'<tt:Behaviour><tt:Speed>{speed:.2f}</tt:Speed></tt:Behaviour></tt:Object>'
+        )
+
+    def frame_time(self, frameIndex):
+        return (self.startTime + timedelta(seconds=frameIndex / self.arguments.fps)).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+    def packet(self, frameIndex):
+        for objectIndex, simulatedObject in enumerate(self.objects):
+            if frameIndex - simulatedObject.birthFrame >= simulatedObject.lifetimeFrames:
+                self.objects[objectIndex] = self.spawn(frameIndex)
+        objects = "".join(self.object_xml(simulatedObject, frameIndex) for simulatedObject in self.objects)
+        packet = (
+            f'<?xml version="1.0" encoding="utf-8"?>\n<tt:MetadataStream {onvifNamespaces}><tt:VideoAnalytics>'
+            f'<tt:Frame UtcTime="{self.frame_time(frameIndex)}">{objects}</tt:Frame></tt:VideoAnalytics></tt:MetadataStream>\n'
+        ).encode()
+        # Motion alarm events like the ones in test.xml, about once a second
+        if frameIndex % max(1, round(self.arguments.fps)) == 0:
+            packet = self.event_packet(frameIndex) + packet
+        if self.random.random() < self.arguments.corruption:
+            packet = self.corrupt(packet)
+        return packet
+
+    def event_packet(self, frameIndex):
+        return (
+            f'<?xml version="1.0" encoding="utf-8"?>\n<tt:MetadataStream {onvifNamespaces}><tt:Event><wsnt:NotificationMessage>'
+            '<wsnt:Topic Dialect="http://www.onvif.org/ver10/tev/topicExpression/ConcreteSet">tns1:VideoSource/MotionAlarm</wsnt:Topic>'
+            f'<wsnt:Message><tt:Message PropertyOperation="Changed" UtcTime="{self.frame_time(frameIndex)}">'
+            '<tt:Source><tt:SimpleItem Name="Source" Value="1" /></tt:Source><tt:Data><tt:SimpleItem Name="State" Value="true" /></tt:Data>'
+            '</tt:Message></wsnt:Message></wsnt:NotificationMessage></tt:Event></tt:MetadataStream>\n'
+        ).encode()
+
+    '''
+        Lost data: cut the packet short, splice in garbage, or flip a byte
+    '''
+    def corrupt(self, packet):
+        position = self.random.randrange(1, len(packet))
+        kind = self.random.choice(("truncate", "garbage", "flip"))
+        if kind == "truncate":
+            return packet[:position]
+        if kind == "garbage":
+            return packet[:position] + bytes(self.random.randrange(256) for _ in range(self.random.randint(1, 64))) + packet[position:]
+        return packet[:position] + bytes([packet[position] ^ 0xFF]) + packet[position + 1:]
+
+    def packets(self):
+        frameIndex = 0
+        while self.arguments.frames == 0 or frameIndex < self.arguments.frames:
+            yield self.packet(frameIndex)
+            frameIndex += 1
+
+
+'''
+    Where a camera's stream goes: "-" for stdout, tcp://host:port to serve it to one reader, anything else is a file path
+'''
+def open_output(output, cameraIndex):
+    if output == "-":
+        return sys.stdout.buffer, None
+    if output.startswith("tcp://"):
+        host, port = output[len("tcp://"):].rsplit(":", 1)
+        server = socket.create_server((host, int(port) + cameraIndex))
+        print(f"Camera {cameraIndex} waiting for a reader on {host}:{int(port) + cameraIndex}", file=sys.stderr)
+        connection, _ = server.accept()
+        server.close()
+        return connection.makefile("wb"), connection
+    return open(output.replace("{camera}", str(cameraIndex)), "wb"), None
+
+
+def run_camera(cameraIndex, arguments, zones, origin):
+    simulator = CameraSimulator(cameraIndex, arguments, zones, origin)
+    stream, connection = open_output(arguments.output, cameraIndex)
+    frameInterval = 1 / (arguments.fps * arguments.speedup) if arguments.speedup > 0 else 0
+    nextFrame = time.monotonic()
+    try:
+        for packet in simulator.packets():
+            stream.write(packet)
+            if frameInterval > 0:
+                stream.flush()
+                nextFrame += frameInterval
+                delay = nextFrame - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+        stream.flush()
+    except (BrokenPipeError, ConnectionResetError):
+        print(f"Camera {cameraIndex}: reader disconnected", file=sys.stderr)
+    finally:
+        if stream is not sys.stdout.buffer:
+            stream.close()
+        if connection != None:
+            connection.close()
+
+
+def parse_arguments(argv = None):
+    argumentParser = argparse.ArgumentParser(description="Synthetic ONVIF metadata stream generator")
+    argumentParser.add_argument("--cameras", type=int, default=1, help="Number of camera streams")
+    argumentParser.add_argument("--objects", type=int, default=20, help="Objects in view per frame")
+    argumentParser.add_argument("--fps", type=float, default=10.0, help="Metadata frames per second of stream time")
+    argumentParser.add_argument("--frames", type=int, default=0, help="Frames per camera, 0 runs forever")
+    argumentParser.add_argument("--lifetime", type=float, default=8.0, help="Mean seconds an object stays in view")
+    argumentParser.add_argument("--types", type=json.loads, default=defaultTypes, help='Object type weights as JSON, e.g. \'{"Car": 0.8, "Truck": 0.2}\'')
+    argumentParser.add_argument("--speed", type=float, nargs=2, default=(2.0, 15.0), metavar=("MIN", "MAX"), help="Object speed range in m/s")
+    argumentParser.add_argument("--zones", help="JSON file with the camera's zones, in the cameras collection format (default: a four way intersection)")
+    argumentParser.add_argument("--origin", type=float, nargs=2, default=defaultOrigin, metavar=("LAT", "LON"), help="Camera coordinates. GeoLocation is written relative to them")
+    argumentParser.add_argument("--corruption", type=float, default=0.0, help="Fraction of packets to corrupt")
+    argumentParser.add_argument("--speedup", type=float, default=1.0, help="Multiple of real time, 0 writes as fast as possible")
+    argumentParser.add_argument("--start", type=datetime.fromisoformat, default=None, help="UtcTime of the first frame (default: now)")
+    argumentParser.add_argument("--seed", type=int, default=0)
+    argumentParser.add_argument("--output", default="-", help="-, a file path, or tcp://host:port")
+    arguments = argumentParser.parse_args(argv)
+    if arguments.start == None:
+        arguments.start = datetime.now(timezone.utc)
+    if arguments.cameras > 1 and arguments.output == "-":
+        argumentParser.error("More than one camera needs a file path with {camera} or a tcp:// output")
+    if arguments.cameras > 1 and not arguments.output.startswith("tcp://") and "{camera}" not in arguments.output:
+        argumentParser.error("More than one camera needs {camera} in the output path")
+    return arguments
+
+
+if __name__ == "__main__":
+    arguments = parse_arguments()
+    zones = defaultZones
+    if arguments.zones:
+        with open(arguments.zones) as zonesFile:
+            zones = json.load(zonesFile)
+    threads = [threading.Thread(target=run_camera, args=(cameraIndex, arguments, zones, tuple(arguments.origin))) for cameraIndex in range(arguments.cameras)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
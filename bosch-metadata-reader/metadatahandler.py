@@ -0,0 +1,237 @@
+import xml.etree.ElementTree as ET
+from typing import Dict
+from collections import defaultdict, OrderedDict
+from datetime import datetime
+
+from camera_object import CameraObject, CompactCameraObject
+from pointSearch import whichLanes
+from collectData import pushObjectData, pushFrameBatch, push_object, ObjectExpiry
+from framebatch import FrameBatchBuilder
+from fieldprojection import countsProjection, compile_dispatch
+from heatmap import HeatmapAccumulator, HeatmapRollup
+
+# The speeds coming off of the camera are in meters per second. Currently multiplying by this factor to convert to mph
+speedFactor = 2.237
+
+# Namespace of the ONVIF metadata elements. The pull parser reports tags as {namespace}Tag
+onvifNamespace = "http://www.onvif.org/ver10/schema"
+
+def qualified(tag):
+    return f"{{{onvifNamespace}}}{tag}"
+
+'''
+    Streaming handler for the camera's metadata: keeps one camera's tracking state and turns parser events into tracked objects.
+    Handlers are looked up in dispatch tables built once, keyed on fully qualified {namespace}Tag strings, so every event costs
+    one dictionary lookup. Only Frame and Object need their start events. Fields are read on end events, when their text is complete,
+    and every other element (the Appearance and Shape subtrees, events, etc.) falls straight through the lookup.
+    fields is the field projection (see fieldprojection.py): only the fields in it get a handler, everything else is skipped.
+    The default is countsProjection, the shapes (BoundingBox, CenterOfGravity) are only parsed when asked for.
+'''
+class MetadataHandler():
+    def __init__(self, camera_info, lanes, dataPushFunction, emitFrameBatches = True, objectExpiry: ObjectExpiry = None, sendCoordinates = None, fields = countsProjection):
+        self.camera_info = camera_info
+        self.lanes = lanes
+        # A rebuilt zone index waiting to be swapped in at the start of the next frame, see set_lanes
+        self.pendingLanes = None
+        self.dataPushFunction = dataPushFunction
+        # Collect each frame as one columnar FrameBatch instead of a camera object per detection. See framebatch.py
+        self.emitFrameBatches = emitFrameBatches
+        # Optional function(coordinateSet, cameraName) for the live coordinate feed
+        self.sendCoordinates = sendCoordinates
+        self.offset = (float(camera_info["coordinates"][0]), float(camera_info["coordinates"][1]))
+
+        # CAMERA SPECIFIC DATA TRACKING OBJECTS. For more info see collectData.py
+        self.activeRoadObjects: Dict[str, CameraObject] = {}
+        self.recentQueue: OrderedDict[str, CameraObject] = OrderedDict()
+        self.objectExpiry = objectExpiry if objectExpiry != None else ObjectExpiry()
+        # For use in the mongodb interface
+        self.currentBin = {
+            "counts": defaultdict(lambda: defaultdict(int)),
+            "speeds": defaultdict(lambda: defaultdict(float)),
+            "timestamp": 0,
+            "heatmap": HeatmapAccumulator()
+        }
+        self.heatmapRollup = HeatmapRollup()
+
+        self.timestamp = None
+        self.frameObjects = []
+        self.frameBatch = FrameBatchBuilder()
+        self.currentObject: CameraObject | FrameBatchBuilder | None = None
+        self.droppedPackets = 0
+
+        self.startHandlers = {
+            qualified("Frame"): self.start_frame,
+            qualified("Object"): self.start_object,
+        }
+        self.endHandlers = {
+            qualified("Frame"): self.end_frame,
+            qualified("Object"): self.end_object,
+        }
+        self.endHandlers.update(compile_dispatch(fields, {
+            "location": self.end_geolocation,
+            "type": self.end_type,
+            "speed": self.end_speed,
+            "boundingBox": self.end_bounding_box,
+            "centerOfGravity": self.end_center_of_gravity,
+        }, qualified))
+
+    '''
+        Parse one complete MetadataStream packet. Bad packets are dropped and counted, the tracking state is kept
+    '''
+    def feed_packet(self, packet):
+        # Every packet is a complete document with its own namespace declarations, so it gets a fresh parser
+        parser = ET.XMLPullParser(['start', 'end'])
+        try:
+            parser.feed(packet)
+            # Raises on a packet that is not well formed, before any of it reaches the tracker
+            parser.close()
+            for event, elem in parser.read_events():
+                self.handle(event, elem)
+        except Exception:
+            self.droppedPackets += 1
+            self.currentObject = None
+
+    def handle(self, event, elem):
+        handler = (self.startHandlers if event == "start" else self.endHandlers).get(elem.tag)
+        if handler != None:
+            handler(elem)
+
+    '''
+        Hand over a new zone index. It is built by the caller, off of the parsing thread (see cameracache.py),
+        and swapped in between frames, so every frame is zoned against one zone set and the bins carry on
+    '''
+    def set_lanes(self, lanes):
+        self.pendingLanes = lanes
+
+    def start_frame(self, elem):
+        if self.pendingLanes != None:
+            self.lanes, self.pendingLanes = self.pendingLanes, None
+            print(f"{self.camera_info['name']}: zones updated to version {getattr(self.lanes, 'version', None)}")
+        # Parsed once here, every object in the frame shares it
+        self.timestamp = datetime.fromisoformat(elem.attrib['UtcTime'])
+        # Drop anything left over from a frame that was cut off by bad data
+        self.frameBatch.reset()
+        self.frameObjects = []
+
+    def start_object(self, elem):
+        if self.emitFrameBatches:
+            # The builder's setters fill in the new row
+            self.frameBatch.add_object(elem.attrib["ObjectId"])
+            self.currentObject = self.frameBatch
+        else:
+            # Tracked objects can live for a long time, so they use the slotted variant with array-backed paths
+            self.currentObject = CompactCameraObject(elem.attrib["ObjectId"], self.timestamp)
+
+    def end_object(self, elem):
+        # Its zone is set once the frame closes
+        if not self.emitFrameBatches:
+            self.frameObjects.append(self.currentObject)
+        self.currentObject = None
+        elem.clear()
+
+    def end_geolocation(self, elem):
+        if self.currentObject == None: return
+        # Frame batches apply the camera offset to the whole frame at once
+        if self.emitFrameBatches:
+            self.currentObject.setLatLon(float(elem.attrib["lat"]), float(elem.attrib["lon"]))
+        else:
+            self.currentObject.setLatLon(float(elem.attrib["lat"]) + self.offset[0], float(elem.attrib["lon"]) + self.offset[1])
+
+    def end_type(self, elem):
+        if self.currentObject == None: return
+        if 'Likelihood' in elem.attrib and elem.text != None:
+            self.currentObject.setDetectedType(elem.text)
+            self.currentObject.setDetectionCertainty(float(elem.attrib['Likelihood']))
+
+    def end_speed(self, elem):
+        if self.currentObject == None: return
+        # Frame batches convert every speed in the frame at once
+        if self.emitFrameBatches:
+            self.currentObject.setSpeed(float(elem.text))
+        else:
+            self.currentObject.setSpeed(float(elem.text) * speedFactor)
+
+    def end_bounding_box(self, elem):
+        if self.currentObject == None: return
+        self.currentObject.set_bounding_box_xml(elem)
+
+    def end_center_of_gravity(self, elem):
+        if self.currentObject == None: return
+        self.currentObject.set_centerofgravity_xml(elem)
+
+    def end_frame(self, elem):
+        if self.emitFrameBatches:
+            self.push_frame_batch()
+        else:
+            self.push_frame_objects()
+        elem.clear()
+
+    '''
+        Frame end for frame batches: offset, convert and zone the whole frame in vectorized passes, then hand it to the tracker
+    '''
+    def push_frame_batch(self):
+        batch = self.frameBatch.build(self.timestamp)
+        if len(batch) > 0:
+            batch.offset_locations(self.offset)
+            batch.scale_speeds(speedFactor)
+            batch.classify_zones(self.lanes)
+            self.send_coordinates(batch.get_coordinate_set)
+        pushFrameBatch(
+            batch,
+            self.camera_info["name"],
+            data_push_function = self.push_data,
+            activeRoadObjects=self.activeRoadObjects,
+            recentQueue=self.recentQueue,
+            currentBin= self.currentBin,
+            heatmapRollup=self.heatmapRollup,
+            expiry=self.objectExpiry)
+
+    def push_frame_objects(self):
+        frameObjects = self.frameObjects
+        if frameObjects != []:
+            # Assign zones to every object in the frame in one pass
+            locations = [roadObject.getCurrentLocation() or (None, None) for roadObject in frameObjects]
+            zoneVersion = getattr(self.lanes, "version", None)
+            for roadObject, lane in zip(frameObjects, whichLanes(locations, self.lanes)):
+                roadObject.add_lane(lane, zoneVersion)
+            self.send_coordinates(lambda: [{
+                "xy": roadObject.getCurrentLocation(),
+                "zone": roadObject.getCurrentZone(),
+                "type": roadObject.getDetectedType()
+            } for roadObject in frameObjects])
+        # Runs on empty frames too so that objects on quiet roads still expire on time
+        pushObjectData(
+            frameObjects,
+            self.camera_info["name"],
+            data_push_function = self.push_data,
+            activeRoadObjects=self.activeRoadObjects,
+            recentQueue=self.recentQueue,
+            currentBin= self.currentBin,
+            heatmapRollup=self.heatmapRollup,
+            expiry=self.objectExpiry,
+            frameTime=self.timestamp)
+        self.frameObjects = []
+
+    '''
+        Send every tracked object to the database as finished, oldest first, for a camera that stops here.
+        The open bin is still in currentBin afterwards, see mongointerface.write_open_bin
+    '''
+    def finish_objects(self):
+        for trackedObject in list(self.recentQueue.values()) + list(self.activeRoadObjects.values()):
+            push_object(trackedObject, self.camera_info["name"], self.push_data, self.currentBin, self.heatmapRollup)
+        self.recentQueue.clear()
+        self.activeRoadObjects.clear()
+
+    # Objects carry the version of the zone set they were last zoned against, this only covers ones that never were
+    def push_data(self, roadObjectData, *context):
+        if roadObjectData.get("zoneVersion") == None:
+            roadObjectData["zoneVersion"] = getattr(self.lanes, "version", None)
+        self.dataPushFunction(roadObjectData, *context)
+
+    # getCoordinateSet is only called when there is somewhere to send the coordinates
+    def send_coordinates(self, getCoordinateSet):
+        if self.sendCoordinates == None: return
+        try:
+            self.sendCoordinates(getCoordinateSet(), self.camera_info["name"])
+        except Exception as error:
+            print("Coordinate Livestream Error", error)
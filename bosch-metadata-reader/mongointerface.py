@@ -1,34 +1,287 @@
+import os
 import pymongo
 import configparser
+import atexit
+import threading
+import time
 from datetime import datetime, timedelta
 from collections import defaultdict
 
-from heatmap import add_to_heatmap, extract_heatmap
+from heatmap import add_to_heatmap, HeatmapAccumulator, HeatmapRollup, get_tile_range
+from countschema import CompactCountCollection
 
 import json
 
 config = configparser.ConfigParser()
 config.read("connection.ini")
-dbUrl = config["DEFAULT"]["database"]
-
-client = pymongo.MongoClient(dbUrl)
-cameraData = client["camera-counts"]
-countCollection  = cameraData["counts"]
-vehicleCollection = cameraData["vehicles"]
-cameraCollection = cameraData["cameras"]
-heatmapCollection = cameraData["heatmaps"]
-
-def collect_heatmap(total_heatmaps, current_bin, amount_to_accumulate):
-    total_heatmaps.append(current_bin["heatmap"])
-    # Logic to determine if it's time to send off heatmap data to server
-    if len(total_heatmaps) >= amount_to_accumulate:
+# Without a connection.ini the module still imports (benchmarks, tools), but only tools that name a database
+# in the CAMERA_COUNTS_DATABASE environment variable can connect. Readers never fall back to some other database
+dbUrl = config["DEFAULT"].get("database", os.environ.get("CAMERA_COUNTS_DATABASE"))
+# Write count bins in the compact schema (the countSeries collection) instead of the counts collection, see countschema.py
+compactCounts = config["DEFAULT"].getboolean("compactCounts", False)
+
+# The client is only created when a collection is first used, see LazyCollection
+client = None
+
+def get_database():
+    global client
+    if client == None:
+        if dbUrl == None:
+            raise RuntimeError("No database in connection.ini, and CAMERA_COUNTS_DATABASE is not set")
+        client = pymongo.MongoClient(dbUrl)
+        create_indexes(client["camera-counts"])
+    return client["camera-counts"]
+
+'''
+    Indexes for the queries and upserts of this module, created once per client if they are missing.
+    A database that is down here only costs the indexes until the next start
+'''
+def create_indexes(database):
+    try:
+        database["heatmapTiles"].create_index([
+            ("location", pymongo.ASCENDING), ("window", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING),
+            ("zoom", pymongo.ASCENDING), ("x", pymongo.ASCENDING), ("y", pymongo.ASCENDING)])
+        # One document per window: concurrent upserts of a new window can not both insert it
+        database["countRollups"].create_index(
+            [("location", pymongo.ASCENDING), ("window", pymongo.ASCENDING), ("timestamp", pymongo.ASCENDING)], unique=True)
+    except Exception as error:
+        print("Could not create the database indexes", error)
+
+def close_client():
+    global client
+    if client == None: return
+    client.close()
+    client = None
+
+'''
+    Stands in for a collection until it is first used, so importing this module does not open a connection pool.
+    Processes that never touch the database (the workers in shardedrunner.py) never create a client
+'''
+class LazyCollection():
+    def __init__(self, name):
+        self.name = name
+
+    def __getattr__(self, attribute):
+        return getattr(get_database()[self.name], attribute)
+
+'''
+    Sends writes for a collection over a multiprocessing queue as (collection name, "insert", documents)
+    or (collection name, "upsert", (filter, update)), for a sink process to write (see shardedrunner.py).
+    Has the parts of the collection interface that this module uses
+'''
+class QueueCollection():
+    def __init__(self, documentQueue, name):
+        self.documentQueue = documentQueue
+        self.name = name
+
+    def insert_many(self, documents, ordered = True):
+        self.documentQueue.put((self.name, "insert", list(documents)))
+
+    def insert_one(self, document):
+        self.documentQueue.put((self.name, "insert", [document]))
+
+    def update_one(self, filter, update, upsert = False):
+        self.documentQueue.put((self.name, "upsert" if upsert else "update", (filter, update)))
+
+countCollection  = LazyCollection("counts")
+vehicleCollection = LazyCollection("vehicles")
+cameraCollection = LazyCollection("cameras")
+heatmapCollection = LazyCollection("heatmaps")
+heatmapTileCollection = LazyCollection("heatmapTiles")
+countRollupCollection = LazyCollection("countRollups")
+# One marker document per kind of data, see mark_write
+writeMarkerCollection = LazyCollection("lastWrites")
+
+# Count rollup windows in seconds. Every closed 5 minute bin is added to all of them
+countRollupWindows = {"hour": 3600, "day": 86400}
+
+# MongoDB's error code for a duplicate key
+duplicateKeyCode = 11000
+
+# The flat {"coordinate", "weight"} heatmap documents, next to the tile pyramid. Dashboards that read tiles can turn this off
+writeFlatHeatmaps = True
+# Rollup windows that also get a flat heatmap document. A day of a busy camera can pass MongoDB's 16MB document limit,
+# so longer windows are only stored as tiles
+flatHeatmapWindows = ("hour",)
+
+'''
+    Buffered writer: collects documents for a collection and writes them with one unordered insert_many
+    once there are maxDocuments of them or the oldest one has waited maxAgeSeconds.
+    A background thread enforces the age limit on quiet cameras, and everything left is flushed at shutdown.
+    A failed write is retried writeAttempts times in all, with only the documents that did not go in.
+    afterWrite, if given, is called with the documents that went in, every time some do
+'''
+class BufferedWriter():
+    def __init__(self, collection, maxDocuments = 200, maxAgeSeconds = 5.0, writeAttempts = 3, retryDelaySeconds = 1.0, afterWrite = None):
+        self.collection = collection
+        self.maxDocuments = maxDocuments
+        self.maxAgeSeconds = maxAgeSeconds
+        self.writeAttempts = writeAttempts
+        self.retryDelaySeconds = retryDelaySeconds
+        self.afterWrite = afterWrite
+        self.documents = []
+        # Time that the oldest document in the buffer was added
+        self.oldestTime = None
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.ageThread = threading.Thread(target=self.flush_on_age, daemon=True)
+        self.ageThread.start()
+        atexit.register(self.close)
+
+    def add(self, document):
+        with self.lock:
+            if len(self.documents) == 0:
+                self.oldestTime = time.monotonic()
+            self.documents.append(document)
+            if len(self.documents) < self.maxDocuments: return
+            documents = self.take_documents()
+        self.write(documents)
+
+    def flush(self):
+        with self.lock:
+            documents = self.take_documents()
+        self.write(documents)
+
+    def flush_on_age(self):
+        while not self.closed.wait(self.maxAgeSeconds / 2):
+            with self.lock:
+                if self.oldestTime == None or time.monotonic() - self.oldestTime < self.maxAgeSeconds:
+                    continue
+                documents = self.take_documents()
+            self.write(documents)
+
+    # Must be called with the lock held
+    def take_documents(self):
+        documents = self.documents
+        self.documents = []
+        self.oldestTime = None
+        return documents
+
+    def write(self, documents):
+        for attempt in range(self.writeAttempts):
+            if len(documents) == 0: return
+            if attempt > 0:
+                time.sleep(self.retryDelaySeconds * 2 ** (attempt - 1))
+            try:
+                self.collection.insert_many(documents, ordered=False)
+                written, documents = documents, []
+            except pymongo.errors.BulkWriteError as error:
+                # insert_many gave every document its _id, so a duplicate key is a document that went in on an earlier attempt
+                failedIndexes = [writeError["index"] for writeError in error.details["writeErrors"] if writeError["code"] != duplicateKeyCode]
+                failed = set(failedIndexes)
+                written = [document for index, document in enumerate(documents) if index not in failed]
+                documents = [documents[index] for index in failedIndexes]
+                lastError = error
+            except Exception as error:
+                written = []
+                lastError = error
+                # Some of the batch may have gone in before the error. Resending is only safe where the collection turns those
+                # away as duplicates, or where no server was ever reached
+                if not getattr(self.collection, "rejectsDuplicates", True) and not isinstance(error, pymongo.errors.ServerSelectionTimeoutError):
+                    break
+            if self.afterWrite != None and len(written) > 0:
+                self.afterWrite(written)
+        if len(documents) > 0:
+            print(f"Failed to write {len(documents)} documents to {self.collection.name}", lastError)
+
+    def close(self):
+        self.closed.set()
+        self.flush()
+
+vehicleWriter = BufferedWriter(vehicleCollection)
+# Bins are added to their rollups once they are written, so the rollups only ever hold bins that are in the database
+countWriter = BufferedWriter(CompactCountCollection(get_database) if compactCounts else countCollection, maxDocuments=20, maxAgeSeconds=10.0, afterWrite=lambda bins: after_count_write(bins))
+
+'''
+    Bump the marker document of a kind of data ("counts" or "heatmaps") once some of it is written. Readers that cache,
+    like the read service, watch the few marker documents instead of polling the data collections
+'''
+def mark_write(kind):
+    try:
+        writeMarkerCollection.update_one({"_id": kind}, {"$set": {"at": datetime.now()}, "$inc": {"writes": 1}}, upsert=True)
+    except Exception as error:
+        print(f"Failed to mark the {kind} write", error)
+
+def after_count_write(bins):
+    rollup_countBins(bins)
+    mark_write("counts")
+
+'''
+    Route every write from this process into a queue instead of the database. The writers still batch,
+    so each queue item is a whole insert_many
+'''
+def send_documents_to(documentQueue):
+    global heatmapCollection, heatmapTileCollection, countRollupCollection, writeMarkerCollection
+    vehicleWriter.collection = QueueCollection(documentQueue, "vehicles")
+    countWriter.collection = QueueCollection(documentQueue, "counts")
+    # The sink's count writer rolls the bins up as it writes them
+    countWriter.afterWrite = None
+    heatmapCollection = QueueCollection(documentQueue, "heatmaps")
+    heatmapTileCollection = QueueCollection(documentQueue, "heatmapTiles")
+    countRollupCollection = QueueCollection(documentQueue, "countRollups")
+    # Heatmap markers follow their tiles through the queue. The sink's count writer marks the counts itself
+    writeMarkerCollection = QueueCollection(documentQueue, "lastWrites")
+
+'''
+    Add the closed bin's heatmap to the camera's rollup windows, and send off any window that it completes,
+    as one document per tile of the tile pyramid (and the flat heatmap document).
+    window is the rollup window ("hour" or "day"), timestamp is the start of the window
+'''
+def collect_heatmap(heatmapRollup: HeatmapRollup, current_bin):
+    write_heatmap_windows(current_bin["location"], heatmapRollup.add_bin(current_bin["timestamp"], current_bin["heatmap"], current_bin["interval"]))
+
+def write_heatmap_windows(location, closedWindows):
+    for window, windowStart, accumulator in closedWindows:
+        tiles = accumulator.build_tiles()
+        for tile in tiles:
+            tile.update({"location": location, "timestamp": windowStart, "window": window})
+        if len(tiles) > 0:
+            heatmapTileCollection.insert_many(tiles)
+            mark_write("heatmaps")
+        if not writeFlatHeatmaps or window not in flatHeatmapWindows: continue
         heatmap_bin = {
-            "location": current_bin["location"],
-            "timestamp": current_bin["timestamp"],
-            "heatmap": extract_heatmap(total_heatmaps),
+            "location": location,
+            "timestamp": windowStart,
+            "window": window,
+            "heatmap": accumulator.extract(),
         }
         heatmapCollection.insert_one(heatmap_bin)
-        del total_heatmaps[:]
+
+'''
+    Write a camera's open 5 minute bin and its open heatmap windows as they are, for a camera that stops in this process.
+    Count rollups add up and heatmap tiles are merged on read, so wherever the camera starts again completes them
+'''
+def write_open_bin(location, heatmapRollup: HeatmapRollup, currentBin):
+    if currentBin["timestamp"] != 0:
+        add_countBin(location, heatmapRollup, currentBin)
+    write_heatmap_windows(location, heatmapRollup.close_all())
+
+'''
+    The heatmap tiles of one rollup window that fall inside a viewport, at one zoom level of the pyramid.
+    A window that was written more than once (split by a restart) has a partial tile per write, their cells are added up here
+'''
+def get_heatmap_tiles(location, window, timestamp: datetime, zoom, south, west, north, east):
+    minX, maxX, minY, maxY = get_tile_range(south, west, north, east, zoom)
+    tiles = {}
+    for tile in heatmapTileCollection.find({
+        "location": location,
+        "window": window,
+        "timestamp": timestamp,
+        "zoom": zoom,
+        "x": {"$gte": minX, "$lte": maxX},
+        "y": {"$gte": minY, "$lte": maxY},
+    }, {"_id": 0}):
+        key = (tile["x"], tile["y"])
+        if key not in tiles:
+            tiles[key] = tile
+            continue
+        merged = tiles[key]
+        cells = {(cellX, cellY): weight for cellX, cellY, weight in merged["cells"]}
+        for cellX, cellY, weight in tile["cells"]:
+            cells[(cellX, cellY)] = cells.get((cellX, cellY), 0) + weight
+        merged["cells"] = [[cellX, cellY, weight] for (cellX, cellY), weight in cells.items()]
+        merged["weight"] += tile["weight"]
+    return list(tiles.values())
 
 
 def round_timestamp(timestamp: datetime, interval = 300):
@@ -47,7 +300,7 @@ def get_camera_data(id = None):
     return list(cameraInfo)
 
 
-def add_countBin(location, total_heatmaps, currentBin):
+def add_countBin(location, heatmapRollup, currentBin):
     time = currentBin["timestamp"]
     counts = currentBin["counts"]
     speeds = currentBin["speeds"]
@@ -57,21 +310,81 @@ def add_countBin(location, total_heatmaps, currentBin):
         "interval": 300,
         "counts": [],
         "speeds": [],
+        # Zone sets the counts were made with, more than one if the zones were edited during the bin
+        "zoneVersions": currentBin.get("zoneVersions", []),
         "heatmap": currentBin["heatmap"]
     }
     for zone in currentBin["counts"]:
-        countsObject = counts[zone]
+        # Plain dicts, so the bin serializes the same everywhere (the sharded sink queue pickles it)
+        countsObject = dict(counts[zone])
         countsObject["zone"] = zone
-        speedsObject = speeds[zone]
+        speedsObject = dict(speeds[zone])
         speedsObject["zone"] = zone
         newBin["counts"].append(countsObject)
         newBin["speeds"].append(speedsObject)
-    collect_heatmap(total_heatmaps, newBin, amount_to_accumulate=12)
+    collect_heatmap(heatmapRollup, newBin)
     newBin.pop("heatmap")
-    countCollection.insert_one(newBin)
+    countWriter.add(newBin)
     print(f"Added data to {location} at {datetime.now()}")
 
-def add_count_mongo(roadObjectData, total_heatmaps, currentBin):
+'''
+    Field name for a zone or type name inside of a rollup document: dots and dollar signs would be read as paths and operators
+'''
+def rollup_field(name):
+    return str(name).replace(".", "_").replace("$", "_")
+
+'''
+    Add written bins to their hourly and daily rollup documents, with one $inc upsert per bin and window, in one bulk write.
+    Rollups keep sums, not averages: counts, speedSums and speedCounts per zone and type, so the average speed is
+    speedSums / speedCounts. Any two partial rollups of a window add up to the right totals, so a window that was
+    split by a restart, or fed by more than one reader, still comes out right. At most the open 5 minute bin is lost.
+    Upserts that fail with a write error did not apply and are retried. That includes the duplicate key of two upserts
+    inserting the same new window at once, the retry finds the window and updates it.
+    Anything else is not retried, an $inc that may have applied can not be sent again
+'''
+def rollup_countBins(bins, attempts = 3):
+    operations = []
+    for newBin in bins:
+        increments = get_rollup_increments(newBin)
+        if len(increments) == 0: continue
+        for window, length in countRollupWindows.items():
+            operations.append(pymongo.UpdateOne(
+                {"location": newBin["location"], "window": window, "timestamp": round_timestamp(newBin["timestamp"], length)},
+                {
+                    "$inc": increments,
+                    "$addToSet": {"zoneVersions": {"$each": newBin.get("zoneVersions", [])}},
+                    "$setOnInsert": {"interval": length},
+                },
+                upsert=True))
+    for attempt in range(attempts):
+        if len(operations) == 0: return
+        try:
+            countRollupCollection.bulk_write(operations, ordered=False)
+            return
+        except pymongo.errors.BulkWriteError as error:
+            operations = [operations[writeError["index"]] for writeError in error.details["writeErrors"]]
+            lastError = error
+        except Exception as error:
+            print(f"Failed to update the rollups of {len(bins)} bins, they may be partly applied", error)
+            return
+    print(f"Failed to apply {len(operations)} rollup updates", lastError)
+
+def get_rollup_increments(newBin):
+    increments = {}
+    for countsObject, speedsObject in zip(newBin["counts"], newBin["speeds"]):
+        zone = rollup_field(countsObject["zone"])
+        for detectedType, count in countsObject.items():
+            if detectedType == "zone": continue
+            field = f"{zone}.{rollup_field(detectedType)}"
+            increments[f"counts.{field}"] = count
+            # The bin's speeds are running averages over its count
+            speed = speedsObject.get(detectedType)
+            if speed != None:
+                increments[f"speedSums.{field}"] = speed * count
+                increments[f"speedCounts.{field}"] = count
+    return increments
+
+def add_count_mongo(roadObjectData, heatmapRollup, currentBin):
     if currentBin["timestamp"] == 0:
         currentBin["timestamp"] = round_timestamp(roadObjectData["timestamp"])
 
@@ -79,11 +392,12 @@ def add_count_mongo(roadObjectData, total_heatmaps, currentBin):
     # Check to see if this object is outside of the bin in memory
     if roadObjectData["timestamp"] >= upperBound:
         # If it is, push that bin to the database and create a new bin
-        add_countBin(roadObjectData["location"], total_heatmaps, currentBin)
+        add_countBin(roadObjectData["location"], heatmapRollup, currentBin)
         currentBin["counts"] = defaultdict(lambda: defaultdict(int))
         currentBin["speeds"] = defaultdict(lambda: defaultdict(float))
         currentBin["timestamp"] = round_timestamp(roadObjectData["timestamp"])
-        currentBin["heatmap"] = {}
+        currentBin["heatmap"] = HeatmapAccumulator()
+        currentBin["zoneVersions"] = []
         
     # Add this object's data to that bin
     if len(roadObjectData["zones"]) == 0:
@@ -97,8 +411,11 @@ def add_count_mongo(roadObjectData, total_heatmaps, currentBin):
         averageSpeed = currentBin["speeds"][zone][roadObjectData["detected_type"]]
         currentBin["speeds"][zone][roadObjectData["detected_type"]] = get_running_average(averageSpeed, roadObjectData["speed"], totalValue)
     add_to_heatmap(currentBin["heatmap"], roadObjectData)
+    zoneVersions = currentBin.setdefault("zoneVersions", [])
+    if roadObjectData.get("zoneVersion") not in zoneVersions:
+        zoneVersions.append(roadObjectData.get("zoneVersion"))
 
-    vehicleCollection.insert_one(roadObjectData)
+    vehicleWriter.add(roadObjectData)
 
 
 def get_running_average(oldValue, newValue, total):
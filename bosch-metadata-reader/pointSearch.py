@@ -1,5 +1,93 @@
+import math
+import json
+import hashlib
+import numpy as np
 from matplotlib import path
 
+# Number of grid cells along each axis of the zone index. The grid only prunes candidates, every answer is still
+# checked against the zone's real path, so this only affects speed
+gridResolution = 16
+
+'''
+    Zone index: keeps the zone paths together with precomputed bounding boxes and a uniform grid over them.
+    Each grid cell stores the zones whose bounding boxes overlap it, in the same order as the original zones,
+    so the first zone that contains a point is the same one the plain loop over every zone would return.
+    Iterating and indexing behave like the original {zone name: Path} dictionary.
+    version identifies the zone set the index was built from (see zone_version), it is recorded with the counts
+'''
+class ZoneIndex():
+    def __init__(self, lanes, resolution = gridResolution, version = None):
+        self.lanes = lanes
+        self.version = version
+        # (name, path, (minX, minY, maxX, maxY)) for every zone, in the original order
+        self.zones = []
+        for lane in lanes:
+            vertices = lanes[lane].vertices
+            if len(vertices) == 0: continue
+            minimums = vertices.min(axis=0)
+            maximums = vertices.max(axis=0)
+            self.zones.append((lane, lanes[lane], (float(minimums[0]), float(minimums[1]), float(maximums[0]), float(maximums[1]))))
+
+        self.cells = {}
+        if len(self.zones) == 0:
+            self.bounds = None
+            return
+
+        # Bounding box of every zone combined - anything outside of it is "Unknown" without checking a single path
+        self.bounds = (
+            min(zone[2][0] for zone in self.zones),
+            min(zone[2][1] for zone in self.zones),
+            max(zone[2][2] for zone in self.zones),
+            max(zone[2][3] for zone in self.zones)
+        )
+        self.resolution = resolution
+        self.cellWidth = ((self.bounds[2] - self.bounds[0]) / resolution) or 1.0
+        self.cellHeight = ((self.bounds[3] - self.bounds[1]) / resolution) or 1.0
+
+        for zone in self.zones:
+            minCell = self.get_cell(zone[2][0], zone[2][1])
+            maxCell = self.get_cell(zone[2][2], zone[2][3])
+            for x in range(minCell[0], maxCell[0] + 1):
+                for y in range(minCell[1], maxCell[1] + 1):
+                    self.cells.setdefault((x, y), []).append(zone)
+
+    '''
+        Grid cell of a coordinate. This is monotonic in both axes, so a point inside of a zone's bounding box
+        always lands in one of the cells that the zone was registered in
+    '''
+    def get_cell(self, x, y):
+        cellX = min(max(math.floor((x - self.bounds[0]) / self.cellWidth), 0), self.resolution - 1)
+        cellY = min(max(math.floor((y - self.bounds[1]) / self.cellHeight), 0), self.resolution - 1)
+        return (cellX, cellY)
+
+    def get_candidates(self, coordinate):
+        x, y = coordinate
+        if self.bounds == None: return []
+        if not (self.bounds[0] <= x <= self.bounds[2] and self.bounds[1] <= y <= self.bounds[3]):
+            return []
+        return self.cells.get(self.get_cell(x, y), [])
+
+    def which_lane(self, coordinate):
+        # Coordinates that can't be placed in the grid (missing or NaN values) take the original path
+        try:
+            candidates = self.get_candidates(coordinate)
+        except (TypeError, ValueError):
+            return whichLane(coordinate, self.lanes)
+        x, y = coordinate
+        for name, lanePath, box in candidates:
+            if box[0] <= x <= box[2] and box[1] <= y <= box[3] and lanePath.contains_points([coordinate]):
+                return name
+        return "Unknown"
+
+    def __iter__(self):
+        return iter(self.lanes)
+
+    def __getitem__(self, lane):
+        return self.lanes[lane]
+
+    def __len__(self):
+        return len(self.lanes)
+
 def setLanes(pointSetsDict):
     lanes = {}
     for pointSetName in pointSetsDict:
@@ -9,11 +97,43 @@ def setLanes(pointSetsDict):
     return lanes
 
 def whichLane(coordinate: tuple[float], lanes):
+    if isinstance(lanes, ZoneIndex):
+        return lanes.which_lane(coordinate)
     for lane in lanes:
         if lanes[lane].contains_points([coordinate]):
             return lane
     return "Unknown"
 
+'''
+    Batch version of whichLane: classify every (lat, lon) point of a frame at once.
+    points is an (n, 2) array, the result is a list of n zone names with the same answers whichLane would give.
+    Each zone gets at most one contains_points call covering all of the points still unassigned inside its bounding box
+'''
+def whichLanes(points, lanes):
+    points = np.asarray(points, dtype=float).reshape(-1, 2)
+    labels = np.full(len(points), "Unknown", dtype=object)
+    if len(points) == 0: return []
+    zones = lanes.zones if isinstance(lanes, ZoneIndex) else [(lane, lanes[lane], None) for lane in lanes]
+    # Points with missing coordinates never land in a zone
+    unassigned = ~np.isnan(points).any(axis=1)
+    for name, lanePath, box in zones:
+        candidates = unassigned.copy()
+        if box != None:
+            candidates &= (points[:, 0] >= box[0]) & (points[:, 0] <= box[2]) & (points[:, 1] >= box[1]) & (points[:, 1] <= box[3])
+        if not candidates.any(): continue
+        candidateIndexes = np.flatnonzero(candidates)
+        inside = candidateIndexes[lanePath.contains_points(points[candidateIndexes])]
+        labels[inside] = name
+        unassigned[inside] = False
+        if not unassigned.any(): break
+    return labels.tolist()
+
+'''
+    Short hash of a camera's zones as stored in the database. Any edit to a zone's name or coordinates changes it
+'''
+def zone_version(dbLanes):
+    return hashlib.sha1(json.dumps(dbLanes, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
 def setLanePairsFromDBList(dbLanes):
     laneCoords = {}
     for lane in dbLanes:
@@ -23,4 +143,4 @@ def setLanePairsFromDBList(dbLanes):
             coordsList[1].append(coordinate["lng"])
         laneCoords[lane['name']] = coordsList
 
-    return setLanes(laneCoords)
\ No newline at end of file
+    return ZoneIndex(setLanes(laneCoords), version=zone_version(dbLanes))
@@ -0,0 +1,250 @@
+'''
+    Read service for the dashboard: a small HTTP API over the counts and heatmaps in the database, with every
+    response kept in an in-memory LRU cache so that many dashboards refreshing at once cost one database query.
+    Cached responses expire after cacheTtlSeconds, and the whole cache is dropped as soon as new count bins, rollups or
+    heatmap tiles are written: the writers bump a marker document in the lastWrites collection (see
+    mongointerface.mark_write), and a background thread polls those few documents. Responses carry an ETag, and a request
+    with a matching If-None-Match gets a 304 without a body.
+
+    GET /counts?location=name[&zone=name]&start=ISO time&end=ISO time[&granularity=5min|hour|day]
+    GET /heatmaps?location=name&timestamp=ISO time[&window=hour|day]&zoom=n&south=lat&west=lon&north=lat&east=lon
+
+    python readservice.py [port]
+'''
+import sys
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import mongointerface
+from countschema import CountTables, countSeriesName, countTablesName, expand_bin
+
+cacheEntries = 512
+cacheTtlSeconds = 60
+# Seconds between checks for newly written bins
+invalidatePollSeconds = 5
+granularities = ("5min", "hour", "day")
+
+'''
+    LRU cache with a time to live. Values are (body, etag)
+'''
+class ResponseCache():
+    def __init__(self, maxEntries = cacheEntries, ttlSeconds = cacheTtlSeconds):
+        self.maxEntries = maxEntries
+        self.ttlSeconds = ttlSeconds
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # Stats
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None or entry[0] < time.monotonic():
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttlSeconds, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+'''
+    Drops the cache whenever a write marker changes
+'''
+class CacheInvalidator():
+    def __init__(self, cache: ResponseCache, markerCollection, pollSeconds = invalidatePollSeconds):
+        self.cache = cache
+        self.markerCollection = markerCollection
+        self.pollSeconds = pollSeconds
+        self.latest = None
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def get_latest(self):
+        return tuple(sorted((marker["_id"], marker.get("writes")) for marker in self.markerCollection.find({}, {"writes": 1})))
+
+    def run(self):
+        while not self.closed.wait(self.pollSeconds):
+            try:
+                latest = self.get_latest()
+            except Exception as error:
+                print("Cache invalidation check failed", error)
+                continue
+            if latest != self.latest:
+                self.latest = latest
+                self.cache.clear()
+
+    def close(self):
+        self.closed.set()
+
+class BadRequest(Exception):
+    pass
+
+def get_argument(query, name, default = None, convert = str):
+    if name not in query:
+        if default == None:
+            raise BadRequest(f"Missing {name}")
+        return default
+    try:
+        return convert(query[name][0])
+    except ValueError:
+        raise BadRequest(f"Bad value for {name}")
+
+def get_time(value):
+    return datetime.fromisoformat(value)
+
+def to_json(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+'''
+    The 5 minute bins of a camera, from the compact schema or the counts collection, as {zone: {type: value}} maps
+'''
+def get_bins(location, start, end):
+    query = {"location": location, "timestamp": {"$gte": start, "$lt": end}}
+    if mongointerface.compactCounts:
+        database = mongointerface.get_database()
+        countTables = CountTables(database[countTablesName])
+        bins = [expand_bin(compact, countTables) for compact in database[countSeriesName].find(query, {"_id": 0}).sort("timestamp", 1)]
+    else:
+        bins = list(mongointerface.countCollection.find(query, {"_id": 0}).sort("timestamp", 1))
+    return [{
+        "timestamp": countBin["timestamp"],
+        "counts": {counts["zone"]: {key: value for key, value in counts.items() if key != "zone"} for counts in countBin["counts"]},
+        "speeds": {speeds["zone"]: {key: value for key, value in speeds.items() if key != "zone"} for speeds in countBin["speeds"]},
+    } for countBin in bins]
+
+'''
+    Hourly or daily windows from the count rollups (see mongointerface.rollup_countBins), with average speeds worked out
+'''
+def get_rollups(location, start, end, window):
+    rollups = mongointerface.countRollupCollection.find(
+        {"location": location, "window": window, "timestamp": {"$gte": start, "$lt": end}}, {"_id": 0}).sort("timestamp", 1)
+    output = []
+    for rollup in rollups:
+        speedSums = rollup.get("speedSums", {})
+        speedCounts = rollup.get("speedCounts", {})
+        output.append({
+            "timestamp": rollup["timestamp"],
+            "counts": rollup.get("counts", {}),
+            "speeds": {
+                zone: {detectedType: speedSums[zone][detectedType] / count for detectedType, count in speedCounts[zone].items() if count > 0}
+                for zone in speedCounts
+            },
+        })
+    return output
+
+def get_counts(query):
+    location = get_argument(query, "location")
+    start = get_argument(query, "start", convert=get_time)
+    end = get_argument(query, "end", convert=get_time)
+    granularity = get_argument(query, "granularity", "5min")
+    if granularity not in granularities:
+        raise BadRequest(f"granularity must be one of {granularities}")
+    if granularity == "5min":
+        results = get_bins(location, start, end)
+    else:
+        results = get_rollups(location, start, end, granularity)
+    zone = get_argument(query, "zone", "")
+    if zone != "":
+        # Rollup documents store names with dots and dollar signs replaced
+        zoneKey = zone if granularity == "5min" else mongointerface.rollup_field(zone)
+        for result in results:
+            result["counts"] = {zone: result["counts"].get(zoneKey, {})}
+            result["speeds"] = {zone: result["speeds"].get(zoneKey, {})}
+    return results
+
+def get_heatmaps(query):
+    return mongointerface.get_heatmap_tiles(
+        get_argument(query, "location"),
+        get_argument(query, "window", "hour"),
+        get_argument(query, "timestamp", convert=get_time),
+        get_argument(query, "zoom", convert=int),
+        get_argument(query, "south", convert=float),
+        get_argument(query, "west", convert=float),
+        get_argument(query, "north", convert=float),
+        get_argument(query, "east", convert=float))
+
+routes = {
+    "/counts": get_counts,
+    "/heatmaps": get_heatmaps,
+}
+
+responseCache = ResponseCache()
+
+class ReadHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        route = routes.get(url.path)
+        if route == None:
+            self.send_json(404, {"error": "Not found"})
+            return
+        query = parse_qs(url.query)
+        # Same query in any parameter order is the same cache entry
+        cacheKey = (url.path, tuple(sorted((name, tuple(values)) for name, values in query.items())))
+        cached = responseCache.get(cacheKey)
+        if cached == None:
+            try:
+                body = json.dumps(route(query), default=to_json).encode()
+            except BadRequest as error:
+                self.send_json(400, {"error": str(error)})
+                return
+            except Exception as error:
+                print("Read service error", error)
+                self.send_json(503, {"error": "Database unavailable"})
+                return
+            cached = (body, f'"{hashlib.sha1(body).hexdigest()}"')
+            responseCache.put(cacheKey, cached)
+        body, etag = cached
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, data):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def run(port = 8080):
+    invalidator = CacheInvalidator(responseCache, mongointerface.writeMarkerCollection)
+    server = ThreadingHTTPServer(("", port), ReadHandler)
+    print(f"Read service on port {port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        invalidator.close()
+        server.server_close()
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 8080)
@@ -1,47 +1,236 @@
-import subprocess
-import threading
+import asyncio
 import signal
+import sys
 import time
+from datetime import timedelta
 
-from pointSearch import setLanes, whichLane, setLanePairsFromDBList
-from mongointerface import add_count_mongo, get_camera_data
+from pointSearch import setLanePairsFromDBList
+from mongointerface import add_count_mongo, write_open_bin
+from cameracache import CameraCache
+from collectData import ObjectExpiry
+from sinkstage import SinkStage
+from metadataframer import MetadataFramer
+from metadatahandler import MetadataHandler
+from fieldprojection import countsProjection
 
-def stream_data(address, name, offset, whichLane, zoneCoordinates, dataPushFunction = add_count_mongo):
+# Same pipeline settings as ffmpegreader.py
+sinkQueueSize = 2000
+sinkPolicy = "spill"
+objectIdleTimeout = timedelta(seconds=1)
+objectFinishTimeout = timedelta(seconds=5)
+extractedFields = countsProjection
+
+# A stream that produces no complete packet for this long is treated as stalled and restarted
+stallTimeout = 30
+# Restart delays double from the first to the last. A stream that stays up for stableAfter seconds starts over at the first
+firstBackoff = 1
+maxBackoff = 300
+stableAfter = 60
+# Seconds between liveness reports
+reportInterval = 60
+readSize = 64 * 1024
+
+def stream_command(camera):
     # The command to access the bosch metadata
-    command = f'python ffmpegreader.py {name}'
-
-    # Fork the active process to open the command line and run ffmpeg
-    with subprocess.Popen(
-        command, shell=True
-    ) as process:
-        print(f"Starting processor for {name}...")
-        # TODO: Implement a drop number
+    return ["ffmpeg", "-i", camera["url"], "-map", "0:d", "-c", "copy", "-copy_unknown", "-loglevel", "fatal", "-f", "data", "-"]
+
+'''
+    One camera's metadata pipe: runs ffmpeg, frames and parses its output in-process, and restarts it when it exits, stalls
+    or its processing fails. The tracking state lives in the handler, so it carries over restarts.
+    Packets are parsed on a worker thread, one chunk at a time, so a busy camera does not hold up the event loop and
+    the other cameras' stall timers. Parsing is still Python, so all the cameras share one core: past that, use shardedrunner.py
+'''
+class CameraStream():
+    def __init__(self, camera_info):
+        self.camera_info = camera_info
+        self.name = camera_info["name"]
+        self.sink = SinkStage(add_count_mongo, maxSize=sinkQueueSize, policy=sinkPolicy, spillPath=f"{self.name}.spill")
+        self.handler = MetadataHandler(
+            camera_info,
+            setLanePairsFromDBList(camera_info["zones"]),
+            dataPushFunction = self.sink.push,
+            objectExpiry = ObjectExpiry(objectIdleTimeout, objectFinishTimeout),
+            fields = extractedFields)
+        self.process = None
+        # Liveness
+        self.state = "starting"
+        self.restarts = 0
+        self.packets = 0
+        self.startedAt = None
+        self.lastPacketAt = None
+        self.lastError = None
+
+    async def run(self):
+        backoff = firstBackoff
+        while True:
+            self.state = "starting"
+            self.startedAt = time.monotonic()
+            try:
+                await self.read_stream()
+                self.lastError = "stream ended"
+            except asyncio.TimeoutError:
+                self.lastError = f"no packets for {stallTimeout}s"
+            except Exception as error:
+                # Includes parsing and sink errors, the camera keeps going after the backoff like it does for a dead pipe
+                self.lastError = f"{type(error).__name__}: {error}"
+            finally:
+                await self.stop_process()
+            if time.monotonic() - self.startedAt >= stableAfter:
+                backoff = firstBackoff
+            self.state = "backoff"
+            self.restarts += 1
+            print(f"{self.name}: {self.lastError}, restarting in {backoff}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, maxBackoff)
+
+    async def read_stream(self):
+        self.process = await asyncio.create_subprocess_exec(*stream_command(self.camera_info), stdout=asyncio.subprocess.PIPE, stdin=asyncio.subprocess.DEVNULL)
+        print(f"Starting processor for {self.name}...")
+        # Cuts the pipe into complete MetadataStream packets, see metadataframer.py
+        framer = MetadataFramer()
+        lastPacketAt = time.monotonic()
         while True:
-            time.sleep(30000)
-    
+            value = await asyncio.wait_for(self.process.stdout.read(readSize), timeout=stallTimeout)
+            if not value: return
+            # If there is bad data, only that packet is dropped. The framer is already at the start of the next one
+            packets = await asyncio.to_thread(self.feed_packets, framer, value)
+            if len(packets) > 0:
+                self.packets += len(packets)
+                self.state = "running"
+                lastPacketAt = self.lastPacketAt = time.monotonic()
+            elif time.monotonic() - lastPacketAt > stallTimeout:
+                # Bytes are arriving but none of them make a packet
+                raise asyncio.TimeoutError()
+
+    # Runs on a worker thread. Only this stream's task calls it, one chunk at a time, so the handler is never shared
+    def feed_packets(self, framer, value):
+        packets = framer.feed(value)
+        for packet in packets:
+            self.handler.feed_packet(packet)
+        return packets
+
+    async def stop_process(self):
+        if self.process == None or self.process.returncode != None: return
+        self.process.kill()
+        await self.process.wait()
+
+    '''
+        Write out everything the camera has, once its stream is stopped: the tracked objects, what the sink still has
+        queued, then the open count bin and heatmap windows. Blocks until the sink is done
+    '''
+    def finish(self):
+        self.handler.finish_objects()
+        self.sink.close()
+        write_open_bin(self.name, self.handler.heatmapRollup, self.handler.currentBin)
+
+    # Builds the zone index on the calling thread, the handler swaps it in between frames
+    def update_zones(self, zones):
+        self.handler.set_lanes(setLanePairsFromDBList(zones))
+
+    def liveness(self):
+        now = time.monotonic()
+        return {
+            "state": self.state,
+            "restarts": self.restarts,
+            "packets": self.packets,
+            "droppedPackets": self.handler.droppedPackets,
+            "secondsSincePacket": None if self.lastPacketAt == None else round(now - self.lastPacketAt, 1),
+            "sinkDepth": self.sink.depth(),
+            "sinkDropped": self.sink.dropped,
+            "lastError": self.lastError,
+        }
+
+'''
+    Runs every camera's stream on one event loop and reports their liveness.
+    Streams can be added and removed while it runs (shardedrunner.py moves cameras between workers this way).
+    With a camera cache, every stream picks up zone edits from its refreshes, and with addNewCameras every camera
+    that a refresh finds for the first time gets a stream
+'''
+class StreamSupervisor():
+    def __init__(self, cameras, cameraCache: CameraCache = None, addNewCameras = False):
+        self.cameraCache = cameraCache
+        self.addNewCameras = addNewCameras
+        self.streams = {}
+        self.tasks = {}
+        for camera in cameras:
+            self.create_stream(camera)
+
+    def create_stream(self, camera):
+        stream = self.streams[camera["name"]] = CameraStream(camera)
+        if self.cameraCache != None:
+            self.cameraCache.watch_zones(stream.name, stream.update_zones)
+
+    def liveness(self):
+        return {name: stream.liveness() for name, stream in self.streams.items()}
+
+    async def report(self):
+        while True:
+            await asyncio.sleep(reportInterval)
+            for name, status in self.liveness().items():
+                print(f"{name}: {status}")
+
+    def start_stream(self, name):
+        self.tasks[name] = asyncio.create_task(self.streams[name].run())
+
+    def add_stream(self, camera):
+        if camera["name"] in self.streams: return
+        self.create_stream(camera)
+        self.start_stream(camera["name"])
+
+    async def remove_stream(self, name):
+        stream = self.streams.pop(name, None)
+        if stream == None: return
+        if self.cameraCache != None:
+            self.cameraCache.unwatch_zones(name)
+        task = self.tasks.pop(name)
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        await stream.stop_process()
+        # Nothing the camera has seen is lost, wherever it runs next carries on from the written bins
+        await asyncio.to_thread(stream.finish)
+
+    '''
+        extraTasks are coroutines that run alongside the streams, until SIGINT or SIGTERM stops everything
+    '''
+    async def run(self, *extraTasks):
+        for name in self.streams:
+            self.start_stream(name)
+        tasks = [asyncio.create_task(self.report())] + [asyncio.create_task(task) for task in extraTasks]
+        loop = asyncio.get_running_loop()
+        if self.cameraCache != None and self.addNewCameras:
+            # Refreshes run on the cache's thread, the stream is started on the loop
+            self.cameraCache.watch_cameras(lambda camera: loop.call_soon_threadsafe(self.add_stream, camera))
+        stopped = asyncio.Event()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stopped.set)
+            except NotImplementedError:
+                # Windows, ctrl-c still raises KeyboardInterrupt
+                pass
+        try:
+            await stopped.wait()
+        finally:
+            for task in tasks + list(self.tasks.values()):
+                task.cancel()
+            await asyncio.gather(*tasks, *self.tasks.values(), return_exceptions=True)
+            for stream in self.streams.values():
+                await stream.stop_process()
 
 def runProcessorMonoProcessing():
-    # Get the necessary information about the camera from the database
-    camera_info = get_camera_data('dunbarton')
-    # Broadcast latitude longitude data
-    # connect_to_server(8001)
-    # Set zone coordinates - global variables with the coordinates of the zone boundaries
-    setLanePairsFromDBList(camera_info["zones"])
-    # Begin streaming the data from the camera
-    stream_data(camera_info["url"], camera_info["name"], whichLane, add_count_mongo)
+    # Get the necessary information about the camera from the local snapshot of the database, see cameracache.py
+    cameraCache = CameraCache()
+    camera = cameraCache.get_camera('dunbarton')
+    if camera == None:
+        sys.exit("Camera dunbarton is not in the cameras collection")
+    asyncio.run(StreamSupervisor([camera], cameraCache).run())
 
 def runProcessorMultiProcessing():
-    # Get the necessary information about the camera from the database
-    camera_info = get_camera_data()
-    # Broadcast latitude longitude data
-    # connect_to_server(8001)
-    # Set zone coordinates - global variables with the coordinates of the zone boundaries
-    for camera in camera_info:
-        t = threading.Thread(target=stream_data, args=(camera["url"], camera["name"], camera["coordinates"], whichLane, camera["zones"], add_count_mongo))
-        signal.signal(signal.SIGINT, signal.SIG_DFL)
-        t.start()
+    # Get the necessary information about the camera from the local snapshot of the database, see cameracache.py
+    cameraCache = CameraCache()
+    asyncio.run(StreamSupervisor(cameraCache.get_cameras(), cameraCache, addNewCameras = True).run())
 
 if __name__ == "__main__":
     runProcessorMultiProcessing()
- 
-
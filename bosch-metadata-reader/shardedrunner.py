@@ -0,0 +1,256 @@
+'''
+    Sharded runner for large sites: spreads the cameras over a fixed pool of worker processes, one per core,
+    instead of one process per camera. Each worker runs a StreamSupervisor (see rtspProcessor.py) for its cameras.
+    Workers never talk to the database: their finished vehicle documents, closed count bins and heatmaps go over
+    one queue to a single sink process, which holds the only MongoClient.
+    When a worker dies it is replaced, and its cameras go to the least loaded workers. A camera that is moved off of a
+    live worker (rebalance) is first stopped there, with its tracked objects and open bin written out, and only started
+    on its new worker once the old one reports that it is done, so it is never counted by two workers at once.
+    The runner keeps the camera cache (see cameracache.py) and forwards zone edits to the worker that has the camera.
+
+    python shardedrunner.py [worker count]
+'''
+import os
+import sys
+import time
+import queue
+import signal
+import asyncio
+import threading
+import multiprocessing
+
+import mongointerface
+from rtspProcessor import StreamSupervisor
+from cameracache import CameraCache
+
+# Seconds between checks on the workers
+monitorInterval = 1
+# Fresh interpreters on every platform: forked children would not get the writers' background threads
+context = multiprocessing.get_context("spawn")
+
+'''
+    Worker process: run the assigned cameras, with every database write sent to the sink's queue.
+    Commands are ("add", camera_info), ("remove", camera name) and ("zones", (camera name, zones)).
+    Every remove is answered with ("removed", camera name) on the event queue, once the camera's data is on its way to the sink
+'''
+def run_worker(cameras, documentQueue, commandQueue, eventQueue):
+    mongointerface.send_documents_to(documentQueue)
+    supervisor = StreamSupervisor(cameras)
+
+    async def receive_commands():
+        while True:
+            try:
+                # Times out so that the thread is free when the supervisor shuts down
+                command, argument = await asyncio.to_thread(commandQueue.get, timeout=1)
+            except queue.Empty:
+                continue
+            if command == "add":
+                supervisor.add_stream(argument)
+            elif command == "remove":
+                # Writes out the camera's tracked objects and open bin, see CameraStream.finish
+                await supervisor.remove_stream(argument)
+                await asyncio.to_thread(mongointerface.vehicleWriter.flush)
+                await asyncio.to_thread(mongointerface.countWriter.flush)
+                eventQueue.put(("removed", argument))
+            elif command == "zones":
+                name, zones = argument
+                if name in supervisor.streams:
+                    # The index is built off of the event loop and swapped in between frames
+                    await asyncio.to_thread(supervisor.streams[name].update_zones, zones)
+
+    asyncio.run(supervisor.run(receive_commands()))
+    # Hand over everything still buffered while the queue can still carry it, the sink is waiting for it
+    for stream in supervisor.streams.values():
+        stream.sink.close()
+    mongointerface.vehicleWriter.flush()
+    mongointerface.countWriter.flush()
+
+'''
+    Sink process: write everything the workers send. Documents for the same collection are batched again here,
+    so one insert_many can hold the documents of several workers. Stops at a None
+'''
+def run_sink(documentQueue):
+    # Ctrl-c reaches every process. The sink keeps going until the runner sends the None after the workers' last documents
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    writers = {
+        "vehicles": mongointerface.vehicleWriter,
+        "counts": mongointerface.countWriter,
+    }
+    while True:
+        item = documentQueue.get()
+        if item == None: break
+        collectionName, operation, payload = item
+        writer = writers.get(collectionName)
+        if operation == "insert" and writer != None:
+            for document in payload:
+                writer.add(document)
+            continue
+        # Heatmaps and rollups are a handful of writes per hour and day
+        try:
+            collection = mongointerface.get_database()[collectionName]
+            if operation == "insert":
+                collection.insert_many(payload, ordered=False)
+            else:
+                collection.update_one(*payload, upsert=operation == "upsert")
+        except Exception as error:
+            print(f"Failed to write to {collectionName}", error)
+    for writer in writers.values():
+        writer.flush()
+    mongointerface.close_client()
+
+class ShardedRunner():
+    def __init__(self, cameras, workerCount = None, cameraCache: CameraCache = None):
+        self.cameras = {camera["name"]: camera for camera in cameras}
+        self.cameraCache = cameraCache
+        if cameraCache != None:
+            for name in self.cameras:
+                self.watch_zones(name)
+        self.workerCount = max(1, min(workerCount or os.cpu_count() or 1, len(self.cameras)))
+        # Guards the assignments and command queues: the monitor loop moves cameras while zone updates come in on the cache's thread
+        self.lock = threading.RLock()
+        self.documentQueue = context.Queue()
+        # Workers report finished removes here
+        self.eventQueue = context.Queue()
+        # Cameras waiting for the worker they are leaving: {camera name: [from slot, to slot]}
+        self.pendingMoves = {}
+        self.sink = context.Process(target=run_sink, args=(self.documentQueue,), name="sink")
+        # Per worker slot: its process, command queue and camera names
+        self.workers = [None] * self.workerCount
+        self.commandQueues = [None] * self.workerCount
+        self.assignments = [[] for _ in range(self.workerCount)]
+        for cameraIndex, name in enumerate(self.cameras):
+            self.assignments[cameraIndex % self.workerCount].append(name)
+        if cameraCache != None:
+            cameraCache.watch_cameras(self.add_camera)
+
+    def watch_zones(self, name):
+        self.cameraCache.watch_zones(name, lambda zones: self.update_zones(name, zones))
+
+    def start_worker(self, slot):
+        with self.lock:
+            self.commandQueues[slot] = context.Queue()
+            cameras = [self.cameras[name] for name in self.assignments[slot]]
+            self.workers[slot] = context.Process(target=run_worker, args=(cameras, self.documentQueue, self.commandQueues[slot], self.eventQueue), name=f"worker-{slot}")
+            self.workers[slot].start()
+            print(f"Started worker {slot} with {self.assignments[slot]}")
+
+    '''
+        A dead worker's cameras go to the least loaded workers. Its slot gets a fresh worker, which rebalance then fills
+    '''
+    def replace_worker(self, slot):
+        with self.lock:
+            print(f"Worker {slot} died with exit code {self.workers[slot].exitcode}, moving {self.assignments[slot]}")
+            orphans = self.assignments[slot]
+            self.assignments[slot] = []
+            self.start_worker(slot)
+            # Cameras that were leaving the dead worker will never be reported as removed
+            for name, (fromSlot, toSlot) in list(self.pendingMoves.items()):
+                if fromSlot == slot:
+                    del self.pendingMoves[name]
+                    self.commandQueues[toSlot].put(("add", self.cameras[name]))
+            for name in orphans:
+                self.move_camera(name, None, self.least_loaded())
+
+    # Runs on the camera cache's thread. Under the lock, the camera is either still on its old worker, which gets the
+    # update before the remove, or it is added to its new worker later, with the new zones
+    def update_zones(self, name, zones):
+        with self.lock:
+            self.cameras[name] = dict(self.cameras[name], zones=zones)
+            for slot, assignment in enumerate(self.assignments):
+                if name in assignment and self.commandQueues[slot] != None:
+                    self.commandQueues[slot].put(("zones", (name, zones)))
+
+    # Runs on the camera cache's thread for a camera that a refresh found for the first time
+    def add_camera(self, camera):
+        name = camera["name"]
+        with self.lock:
+            if name in self.cameras: return
+            self.cameras[name] = camera
+            self.watch_zones(name)
+            slot = self.least_loaded()
+            if self.commandQueues[slot] == None:
+                # Not started yet, start_worker hands it over with the rest of the slot's cameras
+                self.assignments[slot].append(name)
+            else:
+                self.move_camera(name, None, slot)
+            print(f"Added {name} to worker {slot}")
+
+    def least_loaded(self):
+        return min(range(self.workerCount), key=lambda slot: len(self.assignments[slot]))
+
+    '''
+        Move a camera to toSlot. fromSlot is None for a camera that is not running anywhere (its worker died).
+        A camera on a live worker is removed there first and added to toSlot in handle_events, once the remove is done
+    '''
+    def move_camera(self, name, fromSlot, toSlot):
+        with self.lock:
+            if fromSlot != None:
+                self.assignments[fromSlot].remove(name)
+            self.assignments[toSlot].append(name)
+            if name in self.pendingMoves:
+                # Still waiting on the worker it is leaving, it just goes somewhere else once that is done
+                self.pendingMoves[name][1] = toSlot
+            elif fromSlot != None:
+                self.pendingMoves[name] = [fromSlot, toSlot]
+                self.commandQueues[fromSlot].put(("remove", name))
+            else:
+                self.commandQueues[toSlot].put(("add", self.cameras[name]))
+
+    def handle_events(self):
+        while True:
+            try:
+                event, name = self.eventQueue.get_nowait()
+            except queue.Empty:
+                return
+            with self.lock:
+                if event == "removed" and name in self.pendingMoves:
+                    _, toSlot = self.pendingMoves.pop(name)
+                    self.commandQueues[toSlot].put(("add", self.cameras[name]))
+
+    '''
+        Move cameras from the most to the least loaded worker until they differ by at most one.
+        Not run on its own: a dead worker's cameras are spread out without touching the cameras of the others
+    '''
+    def rebalance(self):
+        with self.lock:
+            while True:
+                mostLoaded = max(range(self.workerCount), key=lambda slot: len(self.assignments[slot]))
+                leastLoaded = self.least_loaded()
+                if len(self.assignments[mostLoaded]) - len(self.assignments[leastLoaded]) <= 1: return
+                self.move_camera(self.assignments[mostLoaded][-1], mostLoaded, leastLoaded)
+
+    def run(self):
+        self.sink.start()
+        for slot in range(self.workerCount):
+            self.start_worker(slot)
+        try:
+            while True:
+                time.sleep(monitorInterval)
+                deadSlots = [slot for slot, worker in enumerate(self.workers) if not worker.is_alive()]
+                for slot in deadSlots:
+                    self.replace_worker(slot)
+                self.handle_events()
+                if not self.sink.is_alive():
+                    print(f"Sink died with exit code {self.sink.exitcode}, restarting it")
+                    self.sink = context.Process(target=run_sink, args=(self.documentQueue,), name="sink")
+                    self.sink.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        for worker in self.workers:
+            if worker != None and worker.is_alive():
+                worker.terminate()
+        for worker in self.workers:
+            if worker != None:
+                worker.join()
+        # The workers' last documents are ahead of this in the queue
+        self.documentQueue.put(None)
+        self.sink.join()
+
+if __name__ == "__main__":
+    # Read the cameras from the local snapshot when there is one, see cameracache.py. The runner's client is only used for its refreshes
+    cameraCache = CameraCache()
+    ShardedRunner(cameraCache.get_cameras(), int(sys.argv[1]) if len(sys.argv) > 1 else None, cameraCache).run()
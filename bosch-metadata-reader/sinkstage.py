@@ -0,0 +1,186 @@
+import atexit
+import os
+import pickle
+import queue
+import struct
+import threading
+import time
+
+# Backpressure policies for when the queue is full:
+#   block: the parser waits for room in the queue (nothing is lost, the parser slows down with the database)
+#   drop-oldest: the oldest queued document is thrown away to make room
+#   spill: the document is written to a local file and replayed once the queue drains. Until the file has been
+#          replayed every new document goes to the file too, so documents are still written in the order they came in
+sinkPolicies = ("block", "drop-oldest", "spill")
+
+'''
+    Database sink stage: runs the data push function (add_count_mongo) on a background thread behind a bounded queue,
+    so a slow database never stalls the XML loop. push has the same signature as the data push function,
+    so it can be handed to pushObjectData directly.
+    NOTE: Only the first argument (the road object data) is written to the spill file. The remaining arguments are the
+    per-camera bins, which have to stay the same objects, so the file holds an index into the contexts kept in memory.
+    That makes a spill file useless to any other run: one left behind by a crash is moved aside at start, not replayed
+'''
+class SinkStage():
+    def __init__(self, dataPushFunction, maxSize = 1000, policy = "block", spillPath = None):
+        if policy not in sinkPolicies:
+            raise ValueError(f"Unknown sink policy {policy}, expected one of {sinkPolicies}")
+        if policy == "spill" and spillPath == None:
+            raise ValueError("The spill policy needs a spill path")
+        self.dataPushFunction = dataPushFunction
+        self.policy = policy
+        self.spillPath = spillPath
+        self.queue = queue.Queue(maxsize=maxSize)
+        # Number of documents thrown away by drop-oldest and the number waiting in the spill file
+        self.dropped = 0
+        self.spilled = 0
+        # Set from the first spill until the spill file has been replayed
+        self.spilling = False
+        # Every distinct context that was spilled, and its index by the ids of its objects
+        self.spillContexts = []
+        self.spillContextIndexes = {}
+        self.spillLock = threading.Lock()
+        if spillPath != None:
+            self.move_aside_leftover_spill()
+        self.closed = threading.Event()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+        atexit.register(self.close)
+
+    def push(self, roadObjectData, *context):
+        item = (roadObjectData, context)
+        if self.policy == "block":
+            self.queue.put(item)
+            return
+        if self.spilling:
+            self.spill(item)
+            return
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            if self.policy == "drop-oldest":
+                self.drop_oldest(item)
+            else:
+                self.spill(item)
+
+    '''
+        The number of documents waiting to be written, including the ones spilled to disk
+    '''
+    def depth(self):
+        return self.queue.qsize() + self.spilled
+
+    def stats(self):
+        return {"queued": self.queue.qsize(), "spilled": self.spilled, "dropped": self.dropped}
+
+    def drop_oldest(self, item):
+        while True:
+            try:
+                self.queue.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                continue
+
+    '''
+        Spill files of an earlier run point at bins that died with it. They are kept, renamed, for a look by hand
+    '''
+    def move_aside_leftover_spill(self):
+        for path in (self.spillPath, self.spillPath + ".replay"):
+            if not os.path.exists(path): continue
+            leftoverPath = f"{path}.leftover-{int(time.time())}"
+            os.replace(path, leftoverPath)
+            print(f"Moved the spill file of an earlier run to {leftoverPath}, its documents are not written")
+
+    def spill(self, item):
+        roadObjectData, context = item
+        with self.spillLock:
+            self.spilling = True
+            contextKey = tuple(id(value) for value in context)
+            if contextKey not in self.spillContextIndexes:
+                self.spillContextIndexes[contextKey] = len(self.spillContexts)
+                self.spillContexts.append(context)
+            # Each record is length prefixed, so a bad one can be skipped without losing the ones after it
+            record = pickle.dumps((self.spillContextIndexes[contextKey], roadObjectData))
+            with open(self.spillPath, "ab") as spillFile:
+                spillFile.write(struct.pack("<I", len(record)) + record)
+            self.spilled += 1
+
+    '''
+        Move the spill file out of the way and run everything in it. New spills go to a fresh file in the meantime,
+        which is replayed next. Only once a replay finds nothing new spilled do pushes go back to the queue
+    '''
+    def replay_spill(self):
+        with self.spillLock:
+            if self.spilled == 0:
+                self.spilling = False
+                return
+            replayPath = self.spillPath + ".replay"
+            contexts = list(self.spillContexts)
+            replayCount = self.spilled
+            self.spilled = 0
+            try:
+                os.replace(self.spillPath, replayPath)
+            except OSError as error:
+                print(f"Lost {replayCount} spilled documents, the spill file is gone", error)
+                return
+        replayed = 0
+        with open(replayPath, "rb") as replayFile:
+            for _ in range(replayCount):
+                header = replayFile.read(4)
+                length = struct.unpack("<I", header)[0] if len(header) == 4 else None
+                record = replayFile.read(length) if length != None else b""
+                if length == None or len(record) < length:
+                    print(f"Lost {replayCount - replayed} spilled documents, the spill file is cut off")
+                    break
+                try:
+                    contextIndex, roadObjectData = pickle.loads(record)
+                    context = contexts[contextIndex]
+                except Exception as error:
+                    print("Skipped a spilled document that could not be read", error)
+                    continue
+                self.write((roadObjectData, context))
+                replayed += 1
+        os.remove(replayPath)
+
+    def write(self, item):
+        roadObjectData, context = item
+        try:
+            self.dataPushFunction(roadObjectData, *context)
+        except Exception as error:
+            print("Database sink error", error)
+
+    def run(self):
+        while True:
+            try:
+                if self.run_once(): return
+            except Exception as error:
+                # The worker must outlive anything that goes wrong, otherwise everything after this is never written
+                print("Database sink worker error", error)
+                self.closed.wait(1)
+
+    # Returns True once the stage is closed and everything is written
+    def run_once(self):
+        # Nothing is queued while spilling, so once the queue is empty the spilled documents are the oldest
+        if self.spilling and self.queue.empty():
+            self.replay_spill()
+            return False
+        try:
+            item = self.queue.get(timeout=0.5)
+        except queue.Empty:
+            return self.closed.is_set() and not self.spilling
+        self.write(item)
+        self.queue.task_done()
+        return False
+
+    '''
+        Stop taking new work and wait for everything queued (and spilled) to be written
+    '''
+    def close(self):
+        self.closed.set()
+        if not self.worker.is_alive() and self.depth() > 0:
+            print(f"Database sink worker is not running, {self.depth()} documents were not written")
+        self.worker.join()
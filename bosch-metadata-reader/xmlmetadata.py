@@ -1,5 +1,9 @@
 from bs4 import BeautifulSoup
+import xml.etree.ElementTree as ET
 from camera_object import CameraObject
+from framebatch import FrameBatchBuilder
+from fieldprojection import metadataFields, fullProjection, compile_projection
+from datetime import datetime
 from broadcastlatlon import send_websocket_data
 import json
 import re
@@ -7,70 +11,167 @@ import re
 # The speeds coming off of the camera are in meters per second. Currently multiplying by this factor to convert to mph
 speedFactor = 2.237
 
+'''
+    Parser backends for parseXml. Each one finds the frame in a packet, lists its objects, and reads an object's fields
+    with the same lookups: the first GeoLocation, Speed, BoundingBox and CenterOfGravity anywhere inside the object,
+    the type from VehicleInfo, or from the last Type and first Likelihood inside Class.
+    Only the fields in the projection (see fieldprojection.py) are looked up, the rest come back as None.
+'''
+class SoupBackend():
+    def find_frame(self, inputData):
+        return BeautifulSoup(inputData, 'xml').Frame
+
+    def find_objects(self, videoFrame):
+        return videoFrame.find_all("Object")
+
+    def read_object(self, roadObject, fields):
+        objectType = ""
+        detectionCertainty = 0.0
+        # Search for a type
+        if "type" not in fields:
+            pass
+        elif roadObject.VehicleInfo != None:
+            objectType = roadObject.VehicleInfo.Type.string
+            detectionCertainty = roadObject.VehicleInfo.Type.get("Likelihood")
+        elif roadObject.Class != None:
+            objectType = roadObject.Class.find_all("Type")[-1].string
+            detectionCertainty = roadObject.Class.Likelihood.string
+        speed = None
+        if "speed" in fields and roadObject.Speed != None:
+            speed = float(roadObject.Speed.string)
+        elements = [roadObject.find(metadataFields[field]) if field in fields else None for field in ("location", "boundingBox", "centerOfGravity")]
+        return roadObject.get("ObjectId"), elements[0], objectType, detectionCertainty, speed, elements[1], elements[2]
+
+'''
+    ElementTree (expat) backend: one pass to build the tree, then path lookups with the {*} namespace wildcard.
+    Much faster than BeautifulSoup, but it only takes well-formed packets - BeautifulSoup tries to recover broken ones.
+    An element's string is its text when it has no child elements, like BeautifulSoup's .string for the elements we read
+'''
+class EtreeBackend():
+    def __init__(self):
+        # Search paths compiled once from the field projection spec
+        self.paths = {field: f".//{{*}}{metadataFields[field]}" for field in metadataFields}
+
+    def find_frame(self, inputData):
+        root = ET.fromstring(inputData)
+        if root.tag.rsplit("}", 1)[-1] == "Frame": return root
+        return root.find(".//{*}Frame")
+
+    def find_objects(self, videoFrame):
+        return videoFrame.iterfind(".//{*}Object")
+
+    def read_object(self, roadObject, fields):
+        objectType = ""
+        detectionCertainty = 0.0
+        vehicleInfo = None
+        classElement = None
+        if "type" in fields:
+            vehicleInfo = roadObject.find(".//{*}VehicleInfo")
+            classElement = roadObject.find(".//{*}Class")
+        if vehicleInfo != None:
+            typeElement = require(vehicleInfo.find(".//{*}Type"), "Type")
+            objectType = get_string(typeElement)
+            detectionCertainty = typeElement.get("Likelihood")
+        elif classElement != None:
+            objectType = get_string(classElement.findall(".//{*}Type")[-1])
+            detectionCertainty = get_string(require(classElement.find(".//{*}Likelihood"), "Likelihood"))
+        speed = None
+        speedElement = roadObject.find(self.paths["speed"]) if "speed" in fields else None
+        if speedElement != None:
+            speed = float(get_string(speedElement))
+        elements = [roadObject.find(self.paths[field]) if field in fields else None for field in ("location", "boundingBox", "centerOfGravity")]
+        return roadObject.get("ObjectId"), elements[0], objectType, detectionCertainty, speed, elements[1], elements[2]
+
+def get_string(element):
+    return element.text if len(element) == 0 else None
+
+# Missing elements fail the object the same way BeautifulSoup's attribute lookups do
+def require(element, tag):
+    if element == None:
+        raise AttributeError(f"No {tag} element")
+    return element
+
+parserBackends = {
+    "bs4": SoupBackend(),
+    "etree": EtreeBackend(),
+}
+
 # Return the objects detected in an xml packet
-def parseXml(inputData, whichLane, lanes, cameraName, offset):
+# With asFrameBatch, the objects are returned as one columnar FrameBatch instead of a list of CameraObjects
+# backend picks the parser, see parserBackends. "etree" is the fast one, "bs4" is the original
+# fields is the field projection, see fieldprojection.py
+# whichLanes zones every location of a frame in one call, pointSearch.whichLanes or a replacement with the same signature
+def parseXml(inputData, whichLanes, lanes, cameraName, offset, asFrameBatch = False, backend = "bs4", fields = fullProjection):
+    parserBackend = parserBackends[backend]
+    fields = compile_projection(fields)
     frameObjects = []
+    frameBatch = FrameBatchBuilder()
     # For the purpose of continuity, the parser is placed in a try-except block.
     # If the metadata packet is bad/not formatted correctly, it drops the packet instead of raising an error
     try:
-        xmlSoup = BeautifulSoup(inputData, 'xml')
-        videoFrame = xmlSoup.Frame
+        videoFrame = parserBackend.find_frame(inputData)
         if videoFrame == None: return
         timestamp = videoFrame.get('UtcTime')
+        # A frame batch needs its time up front, a missing or malformed UtcTime drops the packet here
+        frameTime = datetime.fromisoformat(timestamp) if asFrameBatch else None
         coordinateSet = []
     except Exception as error:
         print(error)
-        print(xmlSoup)
+        print(inputData)
         return None
 
     # Each object is in an <Object /> element
-    for roadObject in videoFrame.find_all("Object"):
+    for roadObject in parserBackend.find_objects(videoFrame):
       
         # Add metadata to the detected object
         try:
+            objectId, geoLocation, objectType, detectionCertainty, speed, boundingBox, centerOfGravity = parserBackend.read_object(roadObject, fields)
             lat = None
             lon = None
-            if roadObject.GeoLocation != None:
-                lat = float(roadObject.GeoLocation.get("lat")) + float(offset[0])
-                lon = float(roadObject.GeoLocation.get("lon")) + float(offset[1])
-
-            objectType = ""
-            detectionCertainty = 0.0
-            # Search for a type
-            
-            if roadObject.VehicleInfo != None:
-                objectType = roadObject.VehicleInfo.Type.string
-                detectionCertainty = roadObject.VehicleInfo.Type.get("Likelihood")
-            elif roadObject.Class != None:
-                objectType = roadObject.Class.find_all("Type")[-1].string
-                detectionCertainty = roadObject.Class.Likelihood.string
-            speed = None
-            if roadObject.Speed != None:
-                speed =  float(roadObject.Speed.string) * speedFactor
+            if geoLocation != None:
+                lat = float(geoLocation.get("lat")) + float(offset[0])
+                lon = float(geoLocation.get("lon")) + float(offset[1])
+            if speed != None:
+                speed = speed * speedFactor
+            if asFrameBatch:
+                add_frame_batch_row(frameBatch, objectId, lat, lon, objectType, float(detectionCertainty), speed, boundingBox, centerOfGravity)
+                continue
             currentObject = CameraObject(
-                id = roadObject.get("ObjectId"), 
+                id = objectId, 
                 timestamp= timestamp, 
-                boundingBox= roadObject.BoundingBox, 
-                centerOfGravity= roadObject.CenterOfGravity, 
+                boundingBox= boundingBox, 
+                centerOfGravity= centerOfGravity, 
                 detectedType= objectType, 
                 detectionCertainty= float(detectionCertainty),
                 speed= speed,
                 objectCenter = (lat, lon)
             )
-            lane = whichLane((lat, lon), lanes)
-            currentObject.add_lane(lane)
-            coordinateSet.append({
-                "xy": (lat, lon),
-                "zone": lane,
-                "type": objectType
-            })
-            
             frameObjects.append(currentObject)
         except Exception as error:
             print("\033[31m", error)
             print("\033[33m", roadObject, "\033[0m")
             # return None
         # TODO: Make this multiprocessable: compile all coordinate data into one place and then push it every few seconds(?)
+
+    if asFrameBatch:
+        batch = frameBatch.build(frameTime)
+        batch.classify_zones(lanes, whichLanes)
+        try:
+            send_websocket_data(batch.get_coordinate_set(), cameraName)
+        except Exception as error:
+            print("Coordinate Livestream Error", error)
+        return batch
+
+    # Zone every object of the frame in one pass
+    locations = [roadObject.getCurrentLocation() or (None, None) for roadObject in frameObjects]
+    zoneVersion = getattr(lanes, "version", None)
+    for roadObject, lane in zip(frameObjects, whichLanes(locations, lanes)):
+        roadObject.add_lane(lane, zoneVersion)
+        coordinateSet.append({
+            "xy": roadObject.getCurrentLocation() or (None, None),
+            "zone": lane,
+            "type": roadObject.getDetectedType()
+        })
     try:
         send_websocket_data(coordinateSet, cameraName)
     except Exception as error:
@@ -78,4 +179,18 @@ def parseXml(inputData, whichLane, lanes, cameraName, offset):
  
     return frameObjects
 
-    
\ No newline at end of file
+def add_frame_batch_row(frameBatch, objectId, lat, lon, objectType, detectionCertainty, speed, boundingBox, centerOfGravity):
+    frameBatch.add_object(objectId)
+    try:
+        if lat != None and lon != None:
+            frameBatch.setLatLon(lat, lon)
+        frameBatch.setDetectedType(objectType)
+        frameBatch.setDetectionCertainty(detectionCertainty)
+        frameBatch.setSpeed(speed)
+        if boundingBox != None:
+            frameBatch.set_bounding_box_xml(boundingBox)
+        if centerOfGravity != None:
+            frameBatch.set_centerofgravity_xml(centerOfGravity)
+    except Exception:
+        frameBatch.discard_object()
+        raise